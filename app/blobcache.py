@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+# Least recently used cache of blob bytes, bounded by the total size of the blobs it holds.
+class BlobCache:
+    def __init__(self, budget: int, max_item: int = None):
+        self.budget = budget
+        self.max_item = budget if max_item is None else min(max_item, budget)  # So one huge blob can't flush the cache
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fits(self, size: int) -> bool:
+        return size <= self.max_item
+
+    def get(self, key: str) -> bytes | None:
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not self.fits(len(data)):
+            return
+
+        self.discard(key)
+        self.entries[key] = data
+        self.size += len(data)
+
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def discard(self, key: str):
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime
+from itertools import islice
+from os import environ
+from time import time
+from typing import Iterator
+
+from sqlalchemy.orm import Session
+
+import app.models as models
+from app.blobio import blob_io
+from app.db import run_db
+from app.extractor import blob_store, audio_cache, thumb_cache, blob_lock
+from app.storage import BlobStat, BlobStore, blob_key
+
+# Deletes blobs that no song or thumbnail refers to.
+# The store is listed in batches on the blob io pool, pausing between them, so big libraries don't stall the server.
+# Blobs newer than the grace period are never removed, as they may belong to a download that isn't committed yet.
+gc_interval = int(environ.get('gc_interval', 6 * 60 * 60))  # Seconds between collections, 0 to disable
+gc_grace = int(environ.get('gc_grace', 24 * 60 * 60))
+gc_batch = int(environ.get('gc_batch', 500))
+gc_quarantine = bool(environ.get('gc_quarantine'))  # Move orphans aside for a grace period instead of deleting them
+
+gc_stats = {
+    "runs": 0,
+    "scanned": 0,
+    "removed": 0,
+    "quarantined": 0,
+    "reclaimed_bytes": 0,
+    "last_run": None,
+}
+
+
+def referencedBlobs(db: Session) -> set[str]:
+    songs = db.query(models.Song.data_uuid, models.Song.dataext).filter(models.Song.data_uuid != None).all()
+    thumbnails = db.query(models.Thumbnail.data_uuid, models.Thumbnail.ext).all()
+    return {blob_key(uuid, ext) for uuid, ext in songs + thumbnails}
+
+
+def takeBatch(blobs: Iterator[BlobStat], size: int) -> list[BlobStat]:
+    return list(islice(blobs, size))
+
+
+# Returns the number of blobs removed or quarantined, and the bytes reclaimed
+def sweepBatch(store: BlobStore, batch: list[BlobStat], references: set[str], cutoff: float,
+               quarantine: bool) -> tuple[int, int]:
+    removed = 0
+    reclaimed = 0
+    for blob in batch:
+        if blob.key in references or blob.modified > cutoff:
+            continue
+
+        try:
+            with blob_lock(blob.key):
+                current = store.stat(blob.key)  # A download may have reused it since it was listed
+                if current is None or current.modified > cutoff:
+                    continue
+                if quarantine:
+                    store.quarantine(blob.key)
+                else:
+                    store.delete(blob.key)
+                    reclaimed += blob.size
+        except FileNotFoundError:  # Already gone
+            continue
+
+        audio_cache.discard(blob.key)
+        thumb_cache.discard(blob.key)
+        removed += 1
+
+    return removed, reclaimed
+
+
+def purgeBatch(store: BlobStore, batch: list[BlobStat], cutoff: float) -> int:
+    reclaimed = 0
+    for blob in batch:
+        if blob.modified <= cutoff:
+            store.purge(blob.key)
+            reclaimed += blob.size
+    return reclaimed
+
+
+async def collectGarbage(db: Session, grace: int = None, batch_size: int = None, quarantine: bool = None,
+                         pause: float = 0.05, store: BlobStore = None) -> dict:
+    grace = gc_grace if grace is None else grace
+    batch_size = gc_batch if batch_size is None else batch_size
+    quarantine = gc_quarantine if quarantine is None else quarantine
+    store = store or blob_store
+
+    references = await run_db(referencedBlobs, db)
+    cutoff = time() - grace
+    run = {"scanned": 0, "removed": 0, "quarantined": 0, "reclaimed_bytes": 0}
+
+    blobs = store.list()
+    while batch := await blob_io.run('gc', takeBatch, blobs, batch_size):
+        removed, reclaimed = await blob_io.run('gc', sweepBatch, store, batch, references, cutoff, quarantine)
+        run["scanned"] += len(batch)
+        run["quarantined" if quarantine else "removed"] += removed
+        run["reclaimed_bytes"] += reclaimed
+        await asyncio.sleep(pause)
+
+    quarantined = store.quarantined()
+    while batch := await blob_io.run('gc', takeBatch, quarantined, batch_size):
+        run["reclaimed_bytes"] += await blob_io.run('gc', purgeBatch, store, batch, cutoff)
+        await asyncio.sleep(pause)
+
+    gc_stats["runs"] += 1
+    for key, value in run.items():
+        gc_stats[key] += value
+    gc_stats["last_run"] = datetime.now().isoformat()
+
+    print("Blob gc finished:", run)
+    return run
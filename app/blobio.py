@@ -0,0 +1,76 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import environ
+from time import perf_counter
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+blob_io_workers = int(environ.get('blob_io_workers', 8))
+SAMPLES = 1000  # Latencies kept per operation for the percentiles in stats()
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Timings:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: deque[float] = deque(maxlen=SAMPLES)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def stats(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0,
+            "p50_ms": percentile(samples, 0.5) * 1000 if samples else 0,
+            "p99_ms": percentile(samples, 0.99) * 1000 if samples else 0,
+            "max_ms": self.max * 1000,
+        }
+
+
+# Runs blocking blob reads and writes on their own bounded pool of threads, so a slow disk or object store
+# never stalls the event loop, and can't starve the default executor either.
+# Every operation is timed, including the time spent waiting for a free thread.
+class BlobIO:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="blob-io")
+        self.timings: dict[str, Timings] = {}
+        self.loop_lag = Timings()
+
+    async def run(self, operation: str, func: Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_event_loop()
+        start = perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            self.timings.setdefault(operation, Timings()).record(perf_counter() - start)
+
+    # Samples how late the event loop wakes up from a sleep, which is how long something blocked it
+    async def monitor_loop_lag(self, interval: float = 0.1):
+        while True:
+            start = perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.record(max(perf_counter() - start - interval, 0))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "operations": {operation: timings.stats() for operation, timings in self.timings.items()},
+            "loop_lag": self.loop_lag.stats(),
+        }
+
+
+blob_io = BlobIO(blob_io_workers)
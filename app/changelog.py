@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta
+from os import environ
+from typing import Iterable
+
+from sqlalchemy import event, func, select, inspect, and_
+from sqlalchemy.orm import Session, object_session
+
+import app.models as models
+import app.schemas as schemas
+
+# Every change to songs, playlists and memberships is logged, so clients can ask for what changed since the last
+# version they saw (GET /changes) instead of fetching the whole library again.
+# Entries only say what changed, it's read as it is now when the changes are fetched, so whatever happened to
+# something in between is sent once. That also means entries superseded by a newer one can always be compacted away.
+changes_interval = int(environ.get('changes_interval', 6 * 60 * 60))  # Seconds between compactions, 0 to disable
+changes_retention = int(environ.get('changes_retention', 30 * 24 * 60 * 60))  # Seconds before entries are dropped
+
+SONG = 'song'
+PLAYLIST = 'playlist'
+MEMBERSHIP = 'membership'
+
+Entry = tuple[str, int, int | None]  # (entity, entity id, song id of a membership)
+
+changes_stats = {
+    "compactions": 0,
+    "superseded": 0,
+    "expired": 0,
+    "last_compaction": None,
+}
+
+
+# Logged with the next flush. For bulk statements, which don't flush, use writeChanges.
+def recordChange(session: Session, entry: Entry):
+    session.info.setdefault('changes', {})[entry] = None  # A dict, to keep them in order without duplicates
+
+
+def writeChanges(session: Session, entries: Iterable[Entry]):
+    now = datetime.now()
+    rows = [{"entity": entity, "entity_id": entity_id, "song_id": song_id, "date": now}
+            for entity, entity_id, song_id in entries]
+    if rows:
+        session.connection().execute(models.Change.__table__.insert(), rows)
+
+
+def logChanges(model, entry, fields: list[str]):
+    def changed(mapper, connection, target):
+        recordChange(object_session(target), entry(target))
+
+    # Only changes to what the api returns are logged, not blob metadata and the like
+    def updated(mapper, connection, target):
+        state = inspect(target)
+        if any(state.attrs[field].history.has_changes() for field in fields):
+            changed(mapper, connection, target)
+
+    event.listen(model, 'after_insert', changed)
+    event.listen(model, 'after_update', updated)
+    event.listen(model, 'after_delete', changed)
+
+
+logChanges(models.Song, lambda song: (SONG, song.id, None),
+           ['title', 'duration', 'disabled', 'extractor', 'weburl', 'artist_id', 'artist', 'album_id', 'album'])
+logChanges(models.Playlist, lambda playlist: (PLAYLIST, playlist.id, None), ['title'])
+logChanges(models.PlaylistSong, lambda membership: (MEMBERSHIP, membership.playlist_id, membership.song_id),
+           ['dateadded'])
+
+
+@event.listens_for(Session, "after_flush")
+def flushChanges(session: Session, flush_context):
+    writeChanges(session, session.info.pop('changes', {}))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discardChanges(session: Session, previous_transaction):
+    session.info.pop('changes', None)
+
+
+def compactedThrough(db: Session) -> int:
+    compaction = db.get(models.ChangeCompaction, 1)
+    return 0 if compaction is None else compaction.through
+
+
+# Ids only go up, so this also versions the json responses, the same for every process using the db.
+# One statement, as it's read before every library response. max(id) is a single seek at the end of the rowids.
+def libraryVersion(db: Session) -> int:
+    latest = select(func.max(models.Change.id)).scalar_subquery()
+    compacted = select(models.ChangeCompaction.through).where(models.ChangeCompaction.id == 1).scalar_subquery()
+    return db.scalar(select(func.max(func.coalesce(latest, 0), func.coalesce(compacted, 0))))
+
+
+# None if since is from before the last compaction (or isn't a version of this library), so the client has to
+# fetch the whole library. Without since, only the current version is returned, to start from.
+def changesSince(db: Session, since: int | None) -> schemas.LibraryChanges | None:
+    version = libraryVersion(db)  # Read first, so anything changed while reading is sent again next time
+    if since is None:
+        return schemas.LibraryChanges(version=version)
+    if since < compactedThrough(db) or since > version:
+        return None
+
+    window = and_(models.Change.id > since, models.Change.id <= version)
+    songIds = select(models.Change.entity_id).where(window, models.Change.entity == SONG).distinct()
+    playlistIds = select(models.Change.entity_id).where(window, models.Change.entity == PLAYLIST).distinct()
+    changedMemberships = select(models.Change.entity_id, models.Change.song_id) \
+        .where(window, models.Change.entity == MEMBERSHIP).distinct().subquery()
+
+    songs = db.query(models.Song).filter(models.Song.id.in_(songIds)).all()
+    playlists = db.query(models.Playlist.id, models.Playlist.title).filter(models.Playlist.id.in_(playlistIds)).all()
+    # Each changed membership looked up by playlist_song's primary key, dateadded is None for removed ones
+    memberships = db.query(changedMemberships.c.entity_id, changedMemberships.c.song_id,
+                           models.PlaylistSong.dateadded).outerjoin(
+        models.PlaylistSong, and_(models.PlaylistSong.playlist_id == changedMemberships.c.entity_id,
+                                  models.PlaylistSong.song_id == changedMemberships.c.song_id)) \
+        .order_by(changedMemberships.c.entity_id, changedMemberships.c.song_id).all()
+
+    artistIds = {song.artist_id for song in songs if song.artist_id is not None}
+    albumIds = {song.album_id for song in songs if song.album_id is not None}
+    return schemas.LibraryChanges(
+        version=version,
+        songs=[schemas.LibrarySong.from_orm(song) for song in songs],
+        artists=[schemas.Artist.from_orm(artist)
+                 for artist in db.query(models.Artist).filter(models.Artist.id.in_(artistIds))],
+        albums=[schemas.Album.from_orm(album)
+                for album in db.query(models.Album).filter(models.Album.id.in_(albumIds))],
+        playlists=[schemas.PlaylistBase(id=id, title=title) for id, title in playlists],
+        memberships=[schemas.Membership(playlist_id=playlist_id, song_id=song_id, dateadded=dateadded)
+                     for playlist_id, song_id, dateadded in memberships if dateadded is not None],
+        deleted_songs=sorted(set(db.scalars(songIds)) - {song.id for song in songs}),
+        deleted_playlists=sorted(set(db.scalars(playlistIds)) - {id for id, title in playlists}),
+        deleted_memberships=sorted((playlist_id, song_id) for playlist_id, song_id, dateadded in memberships
+                                   if dateadded is None),
+    )
+
+
+# Drops entries superseded by a newer one for the same thing, which no client needs, and entries older than the
+# retention, which clients that far behind will have to do without.
+def compactChanges(db: Session, retention: int = None) -> dict:
+    retention = changes_retention if retention is None else retention
+
+    latest = select(func.max(models.Change.id)).group_by(models.Change.entity, models.Change.entity_id,
+                                                         models.Change.song_id)
+    superseded = db.query(models.Change).filter(models.Change.id.not_in(latest)).delete(synchronize_session=False)
+
+    expired = 0
+    cutoff = datetime.now() - timedelta(seconds=retention)
+    through = db.query(func.max(models.Change.id)).filter(models.Change.date <= cutoff).scalar()
+    if through is not None:
+        expired = db.query(models.Change).filter(models.Change.id <= through).delete(synchronize_session=False)
+        compaction = db.get(models.ChangeCompaction, 1)
+        if compaction is None:
+            db.add(models.ChangeCompaction(id=1, through=through, date=datetime.now()))
+        else:
+            compaction.through = max(compaction.through, through)
+            compaction.date = datetime.now()
+    db.commit()
+
+    changes_stats["compactions"] += 1
+    changes_stats["superseded"] += superseded
+    changes_stats["expired"] += expired
+    changes_stats["last_compaction"] = datetime.now().isoformat()
+    return {"superseded": superseded, "expired": expired}
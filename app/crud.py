@@ -1,28 +1,183 @@
 import asyncio
 from datetime import datetime
 from hashlib import md5
-from typing import Union, Callable
+from typing import Union, Callable, Coroutine, Hashable
+from uuid import uuid4
 
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, bindparam
+from sqlalchemy.orm import Session, joinedload, selectinload
 from yt_dlp.utils import DownloadError
 
+import app.changelog as changelog
 import app.models as models
 import app.schemas as schemas
-from app.extractor import downloadSong
+import app.scheduler as scheduler
+from app.blobgc import gc_grace
+from app.blobio import blob_io
+from app.db import run_db
+from app.extractor import downloadSong, stored_blob_metadata, audio_mime, image_mime, download_workers, \
+    downloadThumbnail, store_data, release_data
 from app.jobmanager import start_job
+from app.singleflight import SingleFlight
+
+# Concurrent downloads of the same song share one download, so there's only one extraction and one blob
+song_downloads = SingleFlight()
+download_scheduler = scheduler.DownloadScheduler(download_workers)
+
+
+async def scheduledDownloadSong(url: str, priority: int, group: Hashable) -> schemas.SongDownload:
+    async with download_scheduler.slot(priority, group, url):
+        return await downloadSong(url)
 
 
-async def addSong(song: schemas.SongIn, playlists: list[int], db: Session) -> Union[models.Song, bool]:
-    playlistModels = db.query(models.Playlist).filter(models.Playlist.id.in_(playlists)).all()
+# Eager loading for each response shape, so converting to schemas doesn't lazy load everything row by row.
+# Selectin loads take one query per relationship (per 500 parents), however big the library is.
+songLoad = [
+    joinedload(models.Song.artist),
+    joinedload(models.Song.album),
+    selectinload(models.Song.playlists).joinedload(models.PlaylistSong.playlist),
+]
+playlistLoad = [selectinload(models.Playlist.songs).selectinload(models.PlaylistSong.song).options(*songLoad)]
+shallowPlaylistLoad = [selectinload(models.Playlist.songs)]  # Only the song ids are needed
+
+
+def getSongs(db: Session) -> list[models.Song]:
+    return db.query(models.Song).options(*songLoad).all()
+
+
+def getSong(songid: int, db: Session) -> models.Song | None:
+    return db.query(models.Song).options(*songLoad).filter(models.Song.id == songid).first()
+
+
+def getPlaylists(db: Session, shallow: bool = True) -> list[models.Playlist]:
+    return db.query(models.Playlist).options(*(shallowPlaylistLoad if shallow else playlistLoad)).all()
+
+
+def getPlaylist(playlistid: int, db: Session) -> models.Playlist | None:
+    return db.query(models.Playlist).options(*playlistLoad).filter(models.Playlist.id == playlistid).first()
+
+
+# Rows for the json responses built straight from column queries, in the same shape (and key order) as the
+# schemas they stand in for, so they can be encoded without going through the ORM or pydantic.
+# songs limits the rows to the songs selected by that subquery.
+def songRows(db: Session, songs=None) -> dict[int, dict]:
+    query = db.query(models.Song.id, models.Song.title, models.Song.weburl, models.Song.disabled, models.Album.id,
+                     models.Album.title, models.Song.duration, models.Song.extractor, models.Artist.id,
+                     models.Artist.title) \
+        .outerjoin(models.Album, models.Song.album_id == models.Album.id) \
+        .outerjoin(models.Artist, models.Song.artist_id == models.Artist.id) \
+        .order_by(models.Song.id)
+    if songs is not None:
+        query = query.filter(models.Song.id.in_(songs))
+
+    return {
+        id: {
+            "id": id,
+            "title": title,
+            "weburl": weburl,
+            "disabled": disabled,
+            "album": None if album_id is None else {"id": album_id, "title": album},
+            "duration": duration,
+            "extractor": extractor,
+            "artist": None if artist_id is None else {"id": artist_id, "title": artist},
+        } for id, title, weburl, disabled, album_id, album, duration, extractor, artist_id, artist in query
+    }
+
+
+# The playlists each song is in, as schemas.SongPlaylist rows
+def membershipRows(db: Session, songs=None) -> dict[int, list[dict]]:
+    query = db.query(models.PlaylistSong.song_id, models.Playlist.id, models.Playlist.title,
+                     models.PlaylistSong.dateadded) \
+        .join(models.Playlist, models.PlaylistSong.playlist_id == models.Playlist.id) \
+        .order_by(models.PlaylistSong.song_id, models.PlaylistSong.playlist_id)
+    if songs is not None:
+        query = query.filter(models.PlaylistSong.song_id.in_(songs))
+
+    memberships: dict[int, list[dict]] = {}
+    for song_id, id, title, dateadded in query:
+        memberships.setdefault(song_id, []).append({"id": id, "title": title, "dateadded": dateadded})
+    return memberships
+
+
+# schemas.Song rows
+def getSongRows(db: Session) -> list[dict]:
+    memberships = membershipRows(db)
+    return [{**song, "playlists": memberships.get(id, [])} for id, song in songRows(db).items()]
+
+
+# schemas.ShallowPlaylist or schemas.Playlist rows, of every playlist or just the one with playlistid
+def getPlaylistRows(db: Session, shallow: bool = True, playlistid: int = None) -> list[dict]:
+    playlistQuery = db.query(models.Playlist.id, models.Playlist.title).order_by(models.Playlist.id)
+    entryQuery = db.query(models.PlaylistSong.playlist_id, models.PlaylistSong.song_id, models.PlaylistSong.dateadded)
+    songs = None
+    if playlistid is not None:
+        playlistQuery = playlistQuery.filter(models.Playlist.id == playlistid)
+        entryQuery = entryQuery.filter(models.PlaylistSong.playlist_id == playlistid)
+        songs = select(models.PlaylistSong.song_id).where(models.PlaylistSong.playlist_id == playlistid)
 
+    entries: dict[int, list] = {}
+    if shallow:
+        for playlist_id, song_id, dateadded in entryQuery:
+            entries.setdefault(playlist_id, []).append(song_id)
+    else:
+        songRowsById = songRows(db, songs)
+        memberships = membershipRows(db, songs)
+        for playlist_id, song_id, dateadded in entryQuery:
+            entries.setdefault(playlist_id, []).append(
+                {**songRowsById[song_id], "dateadded": dateadded, "playlists": memberships.get(song_id, [])})
+
+    return [{"id": id, "title": title, "songs": entries.get(id, [])} for id, title in playlistQuery]
+
+
+# Only columns, no relationships, as everything is referenced by id
+def getLibrary(db: Session) -> schemas.Library:
+    memberships: dict[int, list[tuple[int, datetime]]] = {}
+    for playlist_id, song_id, dateadded in db.query(models.PlaylistSong.playlist_id, models.PlaylistSong.song_id,
+                                                    models.PlaylistSong.dateadded):
+        memberships.setdefault(playlist_id, []).append((song_id, dateadded))
+
+    return schemas.Library(
+        songs=[schemas.LibrarySong.from_orm(song) for song in db.query(models.Song)],
+        artists=[schemas.Artist.from_orm(artist) for artist in db.query(models.Artist)],
+        albums=[schemas.Album.from_orm(album) for album in db.query(models.Album)],
+        playlists=[schemas.LibraryPlaylist(id=id, title=title, songs=memberships.get(id, []))
+                   for id, title in db.query(models.Playlist.id, models.Playlist.title)],
+    )
+
+
+async def sharedDownloadSong(url: str, priority: int = scheduler.INTERACTIVE,
+                             group: Hashable = None) -> schemas.SongDownload:
+    if url in song_downloads.calls:  # Whoever is waiting for it the most decides its priority
+        download_scheduler.promote(url, priority)
+    return await song_downloads.do(url, lambda: scheduledDownloadSong(url, priority, group))
+
+
+async def sharedDownloadThumbnail(url: str) -> schemas.Thumbnail:
+    key = ('thumbnail', url)
+
+    async def scheduledDownloadThumbnail():
+        async with download_scheduler.slot(scheduler.THUMBNAIL, None, key):
+            return await downloadThumbnail(url)
+
+    return await song_downloads.do(key, scheduledDownloadThumbnail)
+
+
+async def addSong(song: schemas.SongIn, playlists: list[int], db: Session) -> Union[models.Song, bool]:
     try:
-        songDownload: schemas.SongDownload = await downloadSong(song.weburl)
+        songDownload: schemas.SongDownload = await sharedDownloadSong(song.weburl)
     except DownloadError:
         return False
 
     if songDownload.data_uuid is None:
         return False
 
+    return await run_db(storeSong, song, playlists, songDownload, db)
+
+
+# The db half of addSong, run on the db thread once the song is downloaded
+def storeSong(song: schemas.SongIn, playlists: list[int], songDownload: schemas.SongDownload,
+              db: Session) -> Union[models.Song, bool]:
+    playlistModels = db.query(models.Playlist).filter(models.Playlist.id.in_(playlists)).all()
     meta = songDownload.info
 
     artist = song.artist or meta.get('artist') or meta.get('uploader') or None
@@ -53,8 +208,10 @@ async def addSong(song: schemas.SongIn, playlists: list[int], db: Session) -> Un
     if thumbobj is None:
         thumbobj = models.Thumbnail(
             hash=thumbhash,
-            data_uuid=songDownload.data_uuid,
-            ext=songDownload.thumbext
+            data_uuid=songDownload.thumb_uuid,
+            ext=songDownload.thumbext,
+            size=songDownload.thumbsize,
+            mime=songDownload.thumbmime
         )
 
     playlist_additions = [models.PlaylistSong(
@@ -73,6 +230,9 @@ async def addSong(song: schemas.SongIn, playlists: list[int], db: Session) -> Un
             extractor=meta.get('extractor_key'),
             data_uuid=songDownload.data_uuid,
             dataext=songDownload.dataext,
+            datasize=songDownload.datasize,
+            datamime=songDownload.datamime,
+            datahash=songDownload.datahash,
             thumbnail=thumbobj,
         )
     except KeyError as e:
@@ -85,63 +245,96 @@ async def addSong(song: schemas.SongIn, playlists: list[int], db: Session) -> Un
     return songModel
 
 
-async def dbDownloadSong(db: Session, song: models.Song, force: bool = False):
-    song = await downloadExistingSong(song, db, force)
+async def dbDownloadSong(db: Session, song: models.Song, force: bool = False, priority: int = scheduler.INTERACTIVE):
+    old_blob = (song.data_uuid, song.dataext)
+    song = await downloadExistingSong(song, db, force, priority)
 
-    db.commit()
+    await run_db(db.commit)
+    if old_blob[0] is not None and old_blob != (song.data_uuid, song.dataext):
+        await releaseAudio(db, {old_blob})
     return song
 
 
+# Audio blobs are content addressed, so songs with the same audio share a blob.
+# The songs referring to a blob are its reference count, it's only deleted once there are none left.
+# Blobs no song refers to are left out.
+def audioRefCounts(db: Session, data_uuids: set[str]) -> dict[str, int]:
+    counts = {}
+    for chunk in chunked(list(data_uuids)):
+        counts.update(db.query(models.Song.data_uuid, func.count(models.Song.id))
+                      .filter(models.Song.data_uuid.in_(chunk)).group_by(models.Song.data_uuid))
+    return counts
+
+
+# Must be called after the songs no longer referring to the blobs have been committed.
+# A download may be about to reuse a blob counted here, release_data leaves those to the blob gc.
+async def releaseAudio(db: Session, blobs: set[tuple[str, str]]):
+    counts = await run_db(audioRefCounts, db, {data_uuid for data_uuid, dataext in blobs})
+    for data_uuid, dataext in blobs:
+        if data_uuid not in counts:
+            if await blob_io.run('delete', release_data, data_uuid, dataext, gc_grace):
+                print("DELETING BLOB", data_uuid)
+
+
 async def dbDownloadPlaylist(db: Session, playlist: models.Playlist):
-    songs = db.query(models.Song) \
-        .join(models.Song.playlists) \
-        .filter(models.PlaylistSong.playlist_id == playlist.id) \
-        .all()
+    songs = await run_db(lambda: db.query(models.Song)
+                         .join(models.Song.playlists)
+                         .filter(models.PlaylistSong.playlist_id == playlist.id)
+                         .all())
 
     results = await downloadExistingSongs(songs, db)
-    db.commit()
+    await run_db(db.commit)
     return results
 
 
 async def dbDownloadAll(db: Session):
-    songs: list[models.Song] = db.query(models.Song).all()
+    songs: list[models.Song] = await run_db(lambda: db.query(models.Song).all())
 
     results = await downloadExistingSongs(songs, db)
-    db.commit()
+    await run_db(db.commit)
 
     return results
 
 
 async def downloadExistingSongsJob(songs: list[models.Song], db: Session, finish_func: Callable = None):
-    # Fetch all songs concurrently
-    download_coroutines = [downloadExistingSong(song, db) for song in songs]
+    # Fetch all songs concurrently, the scheduler limits how many actually download at once
+    job_id = str(uuid4())
+    download_coroutines = [downloadExistingSong(song, db, priority=scheduler.BULK, group=job_id) for song in songs]
 
     async def finished():
         print("Finished fulldownload, comitting to db...")
-        db.commit()
+        await run_db(db.commit)
         if finish_func is not None:
             finish_func()
         print("Commit and finish function successful")
 
-    job_id = await start_job(download_coroutines, finished())
+    await start_job(download_coroutines, finished(), job_id)
     return job_id
 
 
 async def downloadExistingSongs(songs: list[models.Song], db: Session):
-    # Fetch all songs concurrently
-    results = await asyncio.gather(*[downloadExistingSong(song, db) for song in songs], return_exceptions=True)
+    # Fetch all songs concurrently, the scheduler limits how many actually download at once
+    group = uuid4()
+    results = await asyncio.gather(
+        *[downloadExistingSong(song, db, priority=scheduler.BULK, group=group) for song in songs],
+        return_exceptions=True
+    )
     failures = list(filter(lambda a: a not in results, songs))
     return failures
 
 
-async def downloadExistingSong(song: models.Song, db: Session, force: bool = False):
+async def downloadExistingSong(song: models.Song, db: Session, force: bool = False,
+                               priority: int = scheduler.INTERACTIVE, group: Hashable = None):
     if ((song.data_uuid is None or song.dataext is None) and not song.disabled) or force:
         print(f"Fetching... {song.title} : {song.weburl}")
         try:
-            songdownload = await downloadSong(song.weburl)
+            songdownload = await sharedDownloadSong(song.weburl, priority, group)
 
             song.data_uuid = songdownload.data_uuid
             song.dataext = songdownload.dataext
+            song.datasize = songdownload.datasize
+            song.datamime = songdownload.datamime
+            song.datahash = songdownload.datahash
             song.extractor = songdownload.extractor
             song.duration = songdownload.info['duration']
 
@@ -155,7 +348,9 @@ async def downloadExistingSong(song: models.Song, db: Session, force: bool = Fal
                 song.thumbnail = models.Thumbnail(
                     hash=thumbhash,
                     data_uuid=songdownload.thumb_uuid,
-                    ext=songdownload.thumbext
+                    ext=songdownload.thumbext,
+                    size=songdownload.thumbsize,
+                    mime=songdownload.thumbmime
                 )
 
             song.disabled = False
@@ -170,6 +365,40 @@ async def downloadExistingSong(song: models.Song, db: Session, force: bool = Fal
     return song
 
 
+async def backfillSongMetadata(song: models.Song):
+    song.datasize, song.datahash = await blob_io.run('hash', stored_blob_metadata, song.data_uuid, song.dataext)
+    song.datamime = audio_mime(song.dataext)
+    return song
+
+
+async def backfillThumbnailMetadata(thumbnail: models.Thumbnail):
+    thumbnail.size, _ = await blob_io.run('hash', stored_blob_metadata, thumbnail.data_uuid, thumbnail.ext)
+    thumbnail.mime = image_mime(thumbnail.ext)
+    return thumbnail
+
+
+# Coroutines which record the size, mime type and checksum of blobs downloaded before they were stored in the db
+def blobMetadataBackfills(db: Session) -> list[Coroutine]:
+    songs = db.query(models.Song) \
+        .filter(models.Song.data_uuid != None, models.Song.dataext != None, models.Song.datasize == None) \
+        .all()
+    thumbnails = db.query(models.Thumbnail).filter(models.Thumbnail.size == None).all()
+
+    return [backfillSongMetadata(song) for song in songs] + \
+        [backfillThumbnailMetadata(thumbnail) for thumbnail in thumbnails]
+
+
+async def backfillBlobMetadataJob(db: Session, finish_func: Callable = None):
+    async def finished():
+        print("Finished metadata backfill, comitting to db...")
+        await run_db(db.commit)
+        if finish_func is not None:
+            finish_func()
+
+    job_id = await start_job(await run_db(blobMetadataBackfills, db), finished())
+    return job_id
+
+
 async def getSongSource(song: models.Song, db: Session):
     if song.disabled:
         raise ValueError(f"Disabled song was passed to getSongSource.", song)
@@ -179,16 +408,27 @@ async def getSongSource(song: models.Song, db: Session):
     return song
 
 
+# Only fetches the thumbnail, so the audio isn't downloaded again just to repair a missing thumbnail
 async def getSongThumb(song: models.Song, db: Session):
     try:
-        song = await dbDownloadSong(db, song, True)
-        if song.thumbnail is not None:
-            return song
-        else:
-            return False
+        thumbnail = await sharedDownloadThumbnail(song.weburl)
     except DownloadError as e:
         return False
 
+    thumbobj = await run_db(lambda: db.query(models.Thumbnail).filter(models.Thumbnail.hash == thumbnail.hash).first())
+    if thumbobj is None:
+        thumbobj = models.Thumbnail(
+            hash=thumbnail.hash,
+            data_uuid=await blob_io.run('write', store_data, thumbnail.data, thumbnail.ext),
+            ext=thumbnail.ext,
+            size=len(thumbnail.data),
+            mime=image_mime(thumbnail.ext)
+        )
+
+    song.thumbnail = thumbobj
+    await run_db(db.commit)
+    return song
+
 
 def addSongsToPlaylist(playlist_id: int, song_ids: list[int], db: Session, clear: bool = False):
     playlist = db.get(models.Playlist, playlist_id)
@@ -219,86 +459,156 @@ def addSongsToPlaylist(playlist_id: int, song_ids: list[int], db: Session, clear
     return True
 
 
-def fullSync(syncdata: schemas.FullSync, db: Session):
-    db.query(models.Album).delete()
-    db.query(models.Artist).delete()
-    db.query(models.Playlist).delete()
-    db.query(models.PlaylistSong).delete()
-
-    playlists = syncdata.playlists
-    songsDict = {}
-    artistDict = {}
-    playlistDict = {}
-    albumDict = {}
-
-    existingSongs = {}
-    for song in db.query(models.Song).all():
-        existingSongs[song.weburl] = song
-
-    for playlist in playlists:
-
-        # Initialise this playlist
-        playlistDict[playlist.title] = models.Playlist(
-            title=playlist.title
-        )
-
+def chunked(items: list, size: int = 500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Adds the titles that don't exist yet, returns the ids of all of them by title
+def syncTitles(model, titles: set[str], db: Session) -> tuple[dict[str, int], int]:
+    ids = {title: id for id, title in db.query(model.id, model.title).order_by(model.id.desc())}  # Lowest id wins
+    missing = [{"title": title} for title in titles if title not in ids]
+    if missing:
+        db.execute(model.__table__.insert(), missing)
+        ids = {title: id for id, title in db.query(model.id, model.title).order_by(model.id.desc())}
+    return ids, len(missing)
+
+
+# Makes the library match syncdata, only touching rows that differ, with bulk statements in one transaction.
+# Songs are matched by weburl and playlists by title. Memberships that stay keep their date added, and a playlist's
+# memberships are only rewritten if its order changed. Artists and albums no song refers to anymore are deleted.
+# Bulk statements skip the ORM, so what changed is written to the change log here.
+def fullSync(syncdata: schemas.FullSync, db: Session) -> tuple[schemas.SyncReport, set[tuple[str, str]]]:
+    songTable = models.Song.__table__
+    membershipTable = models.PlaylistSong.__table__
+    report = schemas.SyncReport()
+    changes: list[changelog.Entry] = []
+    now = datetime.now()
+
+    # Playlists with the same title are merged, and a song is only in a playlist once
+    wantedSongs: dict[str, schemas.SongFullSync] = {}
+    wantedPlaylists: dict[str, dict[str, None]] = {}
+    for playlist in syncdata.playlists:
+        weburls = wantedPlaylists.setdefault(playlist.title, {})
         for song in playlist.songs:
-
-            # Check for duplicate
-            # If not duplicate, then need to initialise artist and album
-            if song.weburl not in songsDict:
-
-                if song.weburl in existingSongs:
-                    ormsong = existingSongs[song.weburl]
-                    ormsong.title = song.title
-
-                    del existingSongs[song.weburl]  # So that unsynced songs can be deleted at the end
-
-                else:
-                    # Make new song in db
-                    ormsong = models.Song(
-                        title=song.title,
-                        weburl=song.weburl,
-                        duration=song.duration or None,
-                        extractor=song.extractor or None,
-                    )
-
-                songsDict[song.weburl] = ormsong
-
-                if song.artist:
-                    if song.artist not in artistDict:
-                        artistDict[song.artist] = models.Artist(
-                            title=song.artist,
-                            songs=[ormsong],
-                        )
-                    else:
-                        artistDict[song.artist].songs.append(ormsong)
-
-                # Initialise album
-                if song.album:
-                    if song.album not in albumDict:
-                        albumDict[song.album] = models.Album(
-                            title=song.album,
-                            songs=[ormsong]
-                        )
-                    else:
-                        albumDict[song.album].songs.append(ormsong)
-            else:
-                ormsong = songsDict[song.weburl]
-
-            # Add current song to the current playlist
-            # Must use association
-            association = models.PlaylistSong(dateadded=datetime.now())
-            association.song = ormsong
-            association.playlist = playlistDict[playlist.title]
-
-        db.add(playlistDict[playlist.title])
-
-    for song in existingSongs.values():  # All unsynced songs
-        print("DELETING", song.title)
-        db.delete(song)
-
+            wantedSongs.setdefault(song.weburl, song)
+            weburls[song.weburl] = None
+
+    artistIds, report.artists_added = syncTitles(
+        models.Artist, {song.artist for song in wantedSongs.values() if song.artist}, db)
+    albumIds, report.albums_added = syncTitles(
+        models.Album, {song.album for song in wantedSongs.values() if song.album}, db)
+
+    # Songs
+    existing = {weburl: (id, title, artist_id, album_id)
+                for id, weburl, title, artist_id, album_id in
+                db.query(models.Song.id, models.Song.weburl, models.Song.title, models.Song.artist_id,
+                         models.Song.album_id)}
+    added = []
+    updated = []
+    for weburl, song in wantedSongs.items():
+        artist_id = artistIds[song.artist] if song.artist else None
+        album_id = albumIds[song.album] if song.album else None
+        if weburl not in existing:
+            added.append({"title": song.title, "weburl": weburl, "duration": song.duration or None,
+                          "extractor": song.extractor or None, "disabled": False, "artist_id": artist_id,
+                          "album_id": album_id})
+        elif existing[weburl][1:] != (song.title, artist_id, album_id):
+            updated.append({"song_id": existing[weburl][0], "title": song.title, "artist_id": artist_id,
+                            "album_id": album_id})
+
+    if added:
+        db.execute(songTable.insert(), added)
+        for chunk in chunked([song["weburl"] for song in added]):
+            for id, weburl in db.query(models.Song.id, models.Song.weburl).filter(models.Song.weburl.in_(chunk)):
+                existing[weburl] = (id, None, None, None)
+                changes.append((changelog.SONG, id, None))
+    if updated:
+        db.execute(songTable.update().where(songTable.c.id == bindparam("song_id")), updated)
+        changes += [(changelog.SONG, song["song_id"], None) for song in updated]
+    report.songs_added = len(added)
+    report.songs_updated = len(updated)
+    songIds = {weburl: existing[weburl][0] for weburl in wantedSongs}
+
+    # Playlists, then their memberships one playlist at a time
+    playlistIds: dict[str, int] = {}
+    removedPlaylists = []
+    for id, title in db.query(models.Playlist.id, models.Playlist.title).order_by(models.Playlist.id):
+        if title in wantedPlaylists and title not in playlistIds:
+            playlistIds[title] = id
+        else:
+            removedPlaylists.append(id)
+
+    for title in wantedPlaylists:
+        if title not in playlistIds:
+            playlistIds[title] = db.execute(models.Playlist.__table__.insert().values(title=title)) \
+                .inserted_primary_key[0]
+            changes.append((changelog.PLAYLIST, playlistIds[title], None))
+            report.playlists_added += 1
+
+    for playlist_id in removedPlaylists:
+        members = [song_id for song_id, in db.query(models.PlaylistSong.song_id)
+                   .filter(models.PlaylistSong.playlist_id == playlist_id)]
+        db.execute(membershipTable.delete().where(membershipTable.c.playlist_id == playlist_id))
+        db.execute(models.Playlist.__table__.delete().where(models.Playlist.id == playlist_id))
+        changes.append((changelog.PLAYLIST, playlist_id, None))
+        changes += [(changelog.MEMBERSHIP, playlist_id, song_id) for song_id in members]
+        report.playlists_removed += 1
+        report.memberships_removed += len(members)
+
+    for title, weburls in wantedPlaylists.items():
+        playlist_id = playlistIds[title]
+        wanted = [songIds[weburl] for weburl in weburls]
+        current = {song_id: dateadded for song_id, dateadded in db.query(
+            models.PlaylistSong.song_id, models.PlaylistSong.dateadded)
+            .filter(models.PlaylistSong.playlist_id == playlist_id)}  # In playlist order
+        wantedSet = set(wanted)
+        removed = [song_id for song_id in current if song_id not in wantedSet]
+        kept = [song_id for song_id in current if song_id in wantedSet]
+        new = [song_id for song_id in wanted if song_id not in current]
+
+        if wanted[:len(kept)] == kept:  # Only removals and songs added at the end, so nothing else has to move
+            for chunk in chunked(removed):
+                db.execute(membershipTable.delete().where(membershipTable.c.playlist_id == playlist_id,
+                                                          membershipTable.c.song_id.in_(chunk)))
+            rewritten = new
+        else:
+            db.execute(membershipTable.delete().where(membershipTable.c.playlist_id == playlist_id))
+            rewritten = wanted
+            report.playlists_reordered += 1
+        if rewritten:
+            db.execute(membershipTable.insert(), [
+                {"playlist_id": playlist_id, "song_id": song_id, "dateadded": current.get(song_id, now)}
+                for song_id in rewritten])
+
+        changes += [(changelog.MEMBERSHIP, playlist_id, song_id) for song_id in removed + rewritten]
+        report.memberships_added += len(new)
+        report.memberships_removed += len(removed)
+
+    # Unsynced songs, which are in no playlist anymore
+    released_blobs = set()
+    wantedIds = set(songIds.values())
+    unsynced = [(id, title, data_uuid, dataext) for id, title, data_uuid, dataext in db.query(
+        models.Song.id, models.Song.title, models.Song.data_uuid, models.Song.dataext) if id not in wantedIds]
+    for id, title, data_uuid, dataext in unsynced:
+        print("DELETING", title)
+        if data_uuid is not None:
+            released_blobs.add((data_uuid, dataext))
+        changes.append((changelog.SONG, id, None))
+    for chunk in chunked([id for id, title, data_uuid, dataext in unsynced]):
+        db.execute(membershipTable.delete().where(membershipTable.c.song_id.in_(chunk)))  # Of missing playlists
+        db.execute(songTable.delete().where(songTable.c.id.in_(chunk)))
+    report.songs_removed = len(unsynced)
+
+    for model, column, field in [(models.Artist, models.Song.artist_id, "artists_removed"),
+                                 (models.Album, models.Song.album_id, "albums_removed")]:
+        table = model.__table__
+        setattr(report, field, db.execute(table.delete().where(
+            table.c.id.not_in(select(column).where(column.is_not(None))))).rowcount)
+
+    changelog.writeChanges(db, dict.fromkeys(changes))
     db.commit()
+    return report, released_blobs  # Blobs for releaseAudio, which is async as it deletes them
 
 
 if __name__ == "__main__":
@@ -1,9 +1,15 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import getcwd, environ
 from pathlib import Path
+from typing import Callable, TypeVar
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 dbname = "app.db"
 if environ.get('testdb'):
@@ -16,8 +22,61 @@ elif Path(getcwd()).name == "app" or Path(getcwd()).name == "tests":
 else:
     raise Exception(f"Unknown path: ", getcwd())
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# Sessions are synchronous, so db work is run on its own pool of threads to keep it from blocking the event loop.
+# db_mode 'loop' runs it on the event loop instead, as it used to be.
+db_mode = environ.get('db_mode', 'thread')
+db_workers = int(environ.get('db_workers', 4))
+db_executor = ThreadPoolExecutor(db_workers, thread_name_prefix="db") if db_mode == 'thread' else None
+
+# Pragmas set on every connection. WAL lets reads carry on while something is writing, and with it
+# synchronous=normal is still safe from corruption, only the last commits can be lost on power loss.
+# sqlite_profile=default leaves sqlite's own settings alone.
+sqlite_pragmas = {
+    'journal_mode': environ.get('sqlite_journal_mode', 'wal'),
+    'synchronous': environ.get('sqlite_synchronous', 'normal'),
+    'busy_timeout': int(environ.get('sqlite_busy_timeout', 5000)),  # Milliseconds to wait for another writer
+    'mmap_size': int(environ.get('sqlite_mmap_size', 256 * 1024 * 1024)),
+    'cache_size': int(environ.get('sqlite_cache_size', -64 * 1024)),  # Negative is in KiB
+    'temp_store': environ.get('sqlite_temp_store', 'memory'),
+}
+if environ.get('sqlite_profile') == 'default':
+    sqlite_pragmas = {}
+
+
+# Read only engines refuse writes with query_only, rather than opening the file read only,
+# as a read only connection can't open a WAL database unless a writer already has it open.
+def make_engine(url: str, readonly: bool = False, pragmas: dict = None, pool_size: int = 5) -> Engine:
+    pragmas = sqlite_pragmas if pragmas is None else pragmas
+    engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=pool_size,
+                           max_overflow=pool_size)
+
+    @event.listens_for(engine, 'connect')
+    def applyPragmas(connection, record):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            if not (readonly and name == 'journal_mode'):  # The journal mode is kept in the file, the writer sets it
+                cursor.execute(f"PRAGMA {name}={value}")
+        if readonly:
+            cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+    return engine
+
+
+# Reads get their own pool of connections, so they never wait for one held by a long write such as a full sync
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = make_engine(SQLALCHEMY_DATABASE_URL, readonly=True, pool_size=db_workers)
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+ReadSessionLocal = sessionmaker(bind=read_engine, autoflush=False, autocommit=False)
 
 Base = declarative_base()
+
+T = TypeVar('T')
+
+
+# A session must only be used by one call at a time, so don't run db work concurrently on the same session
+async def run_db(func: Callable[..., T], *args, **kwargs) -> T:
+    if db_executor is None:
+        return func(*args, **kwargs)
+    return await asyncio.get_event_loop().run_in_executor(db_executor, partial(func, *args, **kwargs))
@@ -1,13 +1,21 @@
 import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from hashlib import md5
 from logging import Logger
+from os import environ
 from pathlib import Path
+from time import time
 from urllib.parse import urlparse
 from uuid import uuid4 as makeUUID
 
 from yt_dlp import YoutubeDL as Extractinator
+from yt_dlp.utils import DownloadError
 
 import app.schemas as schemas
+from app.blobcache import BlobCache
+from app.blobio import blob_io
+from app.storage import BlobStore, make_blob_store, blob_key
 
 locallogger = Logger("yt-dl logger", 100000)  # So that stdout isnt spammed by yt-dl
 
@@ -15,96 +23,319 @@ extractDir = Path('./extractions')
 if not extractDir.exists():
     extractDir.mkdir(parents=True)
 
-[x.unlink() for x in extractDir.iterdir()]  # Remove any existing files
-
 db_dir = Path('./db/data').resolve()
 if not db_dir.exists():
     db_dir.mkdir(parents=True)
+blob_store: BlobStore = make_blob_store(db_dir)
+
+
+# Called on startup rather than on import, as extraction worker processes import this module too
+# and mustn't delete files other workers are writing.
+def clear_extractions():
+    [x.unlink() for x in extractDir.iterdir()]  # Remove any existing files
+
+
+# Process pool that is replaced after every worker has done max_tasks tasks on average,
+# so memory leaked by yt-dlp extractors doesn't build up. Tasks already submitted finish in the old pool.
+class RecyclingProcessPool(Executor):
+    def __init__(self, workers: int, max_tasks: int):
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.pool: ProcessPoolExecutor | None = None
+        self.tasks = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self.pool is None or self.tasks >= self.workers * self.max_tasks:
+            old_pool = self.pool
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.tasks = 0
+            if old_pool is not None:
+                old_pool.shutdown(wait=False)
+
+        self.tasks += 1
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+# Extractions get their own workers, so bulk downloads can't starve the default executor used by the api.
+# yt-dlp holds the GIL for most of an extraction, so in process mode they don't slow down the event loop either.
+# How many run at once is decided by the download scheduler in crud.
+download_workers = int(environ.get('download_workers', 4))
+extractor_mode = environ.get('extractor_mode', 'thread')
+if extractor_mode == 'process':
+    extract_executor = RecyclingProcessPool(download_workers, int(environ.get('extractor_max_tasks', 50)))
+else:
+    extract_executor = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="extract")
+
+# Hot blobs are kept in memory, thumbnails are shared between songs so get a separate budget to audio.
+MB = 1024 * 1024
+thumb_cache = BlobCache(int(environ.get('thumb_cache_mb', 32)) * MB, 1 * MB)
+audio_cache = BlobCache(int(environ.get('audio_cache_mb', 128)) * MB, int(environ.get('audio_cache_item_mb', 16)) * MB)
+
+
+# Only for the local store. Pass create when the blob is about to be written, so its shard directory exists
+def get_data_path(uuid: str, ext: str, create: bool = False) -> Path:
+    return blob_store.path(uuid, ext, create)
+
+
+def audio_mime(ext: str) -> str:
+    return f"audio/{ext.lstrip('.')}"
+
 
+def image_mime(ext: str) -> str:
+    return f"image/{ext.lstrip('.')}"
 
-# todo: delete all files that don't belong to a current song
-#       to prevent buildup of unused files
+
+# Size and md5 of a blob on disk, read in chunks so that big songs aren't loaded into memory.
+def blob_metadata(path: Path, chunk_size: int = 1024 * 1024) -> tuple[int, str]:
+    checksum = md5()
+    size = 0
+    with path.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            checksum.update(chunk)
+            size += len(chunk)
+    return size, checksum.hexdigest()
 
 
 def get_data(uuid: str, ext: str) -> bytes:
-    song_path = db_dir.joinpath(f"{uuid}.{ext}")
-    with song_path.open("rb") as f:
-        data = f.read()
+    return blob_store.get(blob_key(uuid, ext))
+
+
+# Size and md5 of a stored blob, read in chunks
+def stored_blob_metadata(uuid: str, ext: str) -> tuple[int, str]:
+    key = blob_key(uuid, ext)
+    checksum = md5()
+    size = 0
+    for chunk in blob_store.get_range(key, 0, blob_store.stat(key).size - 1, 1024 * 1024):
+        checksum.update(chunk)
+        size += len(chunk)
+    return size, checksum.hexdigest()
+
+
+# Returns the blob's bytes from the cache, reading them in if they fit.
+# Returns None if the blob is too big to be cached, so it should be streamed from disk instead.
+# Pass the size if it's known, so that the file doesn't need to be stat'd.
+# Raises FileNotFoundError if the blob isn't stored.
+async def get_cached_data(uuid: str, ext: str, cache: BlobCache, size: int = None) -> bytes | None:
+    key = blob_key(uuid, ext)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    if size is None:
+        stat = await blob_io.run('stat', blob_store.stat, key)
+        if stat is None:
+            raise FileNotFoundError(key)
+        size = stat.size
+    if not cache.fits(size):
+        return None
+
+    data = await blob_io.run('read', blob_store.get, key)
+    cache.put(key, data)
     return data
 
 
-def readData(file: Path) -> bytes:
-    with file.open("rb") as f:
-        filedata = f.read()
+# Held while a download reuses an existing blob, and while a blob is deleted for having no references,
+# so a blob can't be deleted between a download finding it and the download's song being committed. Striped by key.
+blob_locks = [threading.Lock() for _ in range(64)]
+
+
+def blob_lock(key: str) -> threading.Lock:
+    return blob_locks[hash(key) % len(blob_locks)]
+
+
+# Moves an extracted file into the blob store, returning its new uuid, size and md5.
+# The file is hashed in chunks and then handed to the store, so it's never held in memory.
+# Content addressed blobs use their md5 as their uuid, so identical files share one blob
+# and ingesting the same file twice is harmless.
+def ingest_file(path: Path, ext: str, content_addressed: bool = False) -> tuple[str, int, str]:
+    size, checksum = blob_metadata(path)
+
+    uuid = checksum if content_addressed else str(makeUUID())
+    key = blob_key(uuid, ext)
+    if content_addressed:
+        with blob_lock(key):
+            reused = blob_store.stat(key) is not None
+            if reused:
+                blob_store.touch(key)  # Counts as new again, so it isn't deleted before the song is committed
+        if reused:
+            path.unlink()
+            return uuid, size, checksum
+
+    blob_store.put_file(key, path)
+    return uuid, size, checksum
+
 
-    file.unlink()
-    return filedata
+# Long-lived YoutubeDL instances, one per worker thread (or process) for each set of options.
+# Making one registers every extractor and parses all the options, which is a big part of downloading a short song.
+ytdl_instances = threading.local()
 
 
-def extract(options, url):
-    with Extractinator(options) as downloader:
+# The logger is added here as loggers can't be sent to extraction worker processes.
+def get_ytdl(options: dict) -> Extractinator:
+    instances = getattr(ytdl_instances, 'instances', None)
+    if instances is None:
+        instances = ytdl_instances.instances = {}
+
+    key = repr(sorted(options.items()))
+    downloader = instances.get(key)
+    if downloader is None:
+        downloader = instances[key] = Extractinator({**options, "logger": locallogger})
+    return downloader
+
+
+# The output template is given separately, so that the same downloader can be reused for every download.
+# Slim should be set when running in a worker process, so the info can be sent back.
+def extract(options, url, outtmpl: str = None, slim: bool = False):
+    downloader = get_ytdl(options)
+    if outtmpl is not None:
+        # yt-dlp up to 2022 reads the templates parsed in __init__ (outtmpl_dict), later versions read them from params
+        if 'outtmpl_dict' in vars(downloader):
+            downloader.outtmpl_dict['default'] = outtmpl
+        downloader.params.setdefault('outtmpl', {})['default'] = outtmpl
+
+    try:
         info = downloader.extract_info(url)
+        if slim:
+            info = slimInfo(downloader.sanitize_info(info))
+    except DownloadError as e:
+        if slim:  # The original holds a traceback, which can't be sent back from a worker process
+            raise DownloadError(e.msg) from None
+        raise
     return info
 
 
-def extractInfo(options, url):
-    with Extractinator(options) as downloader:
-        info = downloader.extract_info(url, download=False)
+# Only keeps what downloadSong uses, so the info is cheap to send back from a worker process
+def slimInfo(info: dict) -> dict:
+    info = {key: value for key, value in info.items()
+            if key not in ('formats', 'requested_formats', 'subtitles', 'automatic_captions', 'heatmap')}
+    if info.get('thumbnails'):
+        info['thumbnails'] = info['thumbnails'][-1:]
     return info
 
 
+# Only fetches the metadata and the best thumbnail, without downloading any audio.
+def extractThumbnail(options, url) -> tuple[str, bytes]:
+    downloader = get_ytdl(options)
+    try:
+        info = downloader.extract_info(url, download=False)
+    except DownloadError as e:
+        raise DownloadError(e.msg) from None  # The original holds a traceback, which can't be sent between processes
+
+    thumb_url = info.get('thumbnail') or (info.get('thumbnails') or [{}])[-1].get('url')
+    if thumb_url is None:
+        raise DownloadError(f"No thumbnail found for {url}")
+
+    try:
+        with downloader.urlopen(thumb_url) as response:
+            data = response.read()
+    except Exception as e:  # Network errors (a dead thumbnail url, say) aren't DownloadErrors, so callers would miss them
+        raise DownloadError(f"Could not fetch thumbnail {thumb_url}: {e}") from None
+    return thumb_url, data
+
+
+def extractInfo(options, url):
+    return get_ytdl(options).extract_info(url, download=False)
+
+
+download_options = {
+    "noplaylist": True,
+    "playlistend": 0,  # Ensures that playlists aren't downloaded
+    "format": "worstaudio",
+    "writethumbnail": True,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+
 async def downloadSong(url: str) -> schemas.SongDownload:
     loop = asyncio.get_event_loop()
 
     uuid = str(makeUUID())  # Use uuid to prevent any name collisions with multiple downloads at once
-    options = {
-        "noplaylist": True,
-        "playlistend": 0,  # Ensures that playlists aren't downloaded
-        "format": "worstaudio",
-        "outtmpl": f'./extractions/{uuid}',
-        "writethumbnail": True,
-        "quiet": True,
-        "no_warnings": True,
-        "logger": locallogger
-    }
+    outtmpl = f'./extractions/{uuid}'
 
-    info = await loop.run_in_executor(None, extract, options, url)
+    info = await loop.run_in_executor(extract_executor, extract, download_options, url, outtmpl,
+                                      extractor_mode == 'process')
 
     extracted_file_path = Path(info['requested_downloads'][0]['filepath'])
     extracted_thumb_path = Path(info['thumbnails'][-1]['filepath'])
 
-    datauuid = str(makeUUID())
-    thumbuuid = str(makeUUID())
-
     if info.get('_type') == "playlist":
-        extracted_file_path.unlink()
-        extracted_thumb_path.unlink()
+        await blob_io.run('delete', extracted_file_path.unlink)
+        await blob_io.run('delete', extracted_thumb_path.unlink)
         raise ValueError("Playlist url provided.")
 
     data_ext = info['ext']
     thumb_ext = Path(urlparse(info['thumbnail']).path).suffix[1:]  # Get extension from web url, with period removed
 
-    filedata = readData(extracted_file_path)
-    new_file_path = db_dir.joinpath(f"./{datauuid}.{data_ext}")
-    with new_file_path.open("wb") as f:
-        f.write(filedata)
-
-    thumbdata = readData(extracted_thumb_path)
-    new_file_path = db_dir.joinpath(f"./{thumbuuid}.{thumb_ext}")
-    with new_file_path.open("wb") as f:
-        f.write(thumbdata)
+    datauuid, datasize, datahash = await blob_io.run('ingest', ingest_file, extracted_file_path, data_ext, True)
+    thumbuuid, thumbsize, thumbhash = await blob_io.run('ingest', ingest_file, extracted_thumb_path, thumb_ext)
 
     return schemas.SongDownload(
         data_uuid=datauuid,
         dataext=data_ext,
+        datasize=datasize,
+        datamime=audio_mime(data_ext),
+        datahash=datahash,
         thumb_uuid=thumbuuid,
         thumbext=thumb_ext,
-        thumb_hash=md5(thumbdata).hexdigest(),
+        thumb_hash=thumbhash,
+        thumbsize=thumbsize,
+        thumbmime=image_mime(thumb_ext),
         info=info,
         extractor=info['extractor_key']
     )
 
 
+thumbnail_options = {
+    "noplaylist": True,
+    "playlistend": 0,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+
+async def downloadThumbnail(url: str) -> schemas.Thumbnail:
+    loop = asyncio.get_event_loop()
+    thumb_url, data = await loop.run_in_executor(extract_executor, extractThumbnail, thumbnail_options, url)
+
+    return schemas.Thumbnail(
+        hash=md5(data).hexdigest(),
+        data=data,
+        ext=Path(urlparse(thumb_url).path).suffix[1:]  # Get extension from web url, with period removed
+    )
+
+
+def delete_data(uuid: str, ext: str):
+    key = blob_key(uuid, ext)
+    blob_store.delete(key)
+    audio_cache.discard(key)
+    thumb_cache.discard(key)
+
+
+# Deletes a blob nothing refers to any more, unless it was stored or reused in the last grace seconds,
+# as then it may belong to a download whose song isn't committed yet. Those are left to the blob gc.
+# Returns whether it was deleted.
+def release_data(uuid: str, ext: str, grace: float) -> bool:
+    key = blob_key(uuid, ext)
+    with blob_lock(key):
+        stat = blob_store.stat(key)
+        if stat is None or stat.modified > time() - grace:
+            return False
+        delete_data(uuid, ext)
+    return True
+
+
+# Writes a new blob into the blob store, returning its uuid
+def store_data(data: bytes, ext: str) -> str:
+    uuid = str(makeUUID())
+    blob_store.put(blob_key(uuid, ext), data)
+    return uuid
+
+
 # Perhaps take a progress callback parameter, so progress can be updated as it downloads large playlists.
 async def downloadPlaylist(url: str) -> schemas.PlaylistDownload:
     uuid = str(makeUUID())
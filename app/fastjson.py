@@ -0,0 +1,27 @@
+import json
+from datetime import datetime
+
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # A dependency, but the standard library encoder still works (slower) without it
+    orjson = None
+    print("orjson isn't installed, encoding json with the standard library")
+
+
+def default(o):
+    if isinstance(o, BaseModel):
+        return o.dict()
+    if isinstance(o, datetime):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# Encodes plain rows (and schemas) like fastapi's JSONResponse would, without jsonable_encoder.
+# orjson's output is the same json, though it writes some floats differently, e.g. 1e-7 rather than 1e-07.
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=default)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"),
+                      default=default).encode("utf-8")
@@ -34,8 +34,9 @@ async def coroutine_wrapper(coroutine: Coroutine, job: Job, on_finish: Coroutine
 
 
 # Takes a coroutine, runs it, and returns a job id which can be used to get its status.
-async def start_job(coroutines: list[Coroutine], on_finish: Coroutine = None) -> str:
-    newjobid = str(uuid())
+# A job id can be given if the coroutines need to know it before the job is started.
+async def start_job(coroutines: list[Coroutine], on_finish: Coroutine = None, job_id: str = None) -> str:
+    newjobid = job_id or str(uuid())
     job = Job(
         job_id=newjobid,
         size=len(coroutines),
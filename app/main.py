@@ -1,26 +1,40 @@
 import asyncio
-import io
 from datetime import datetime
+from functools import partial
 from os import environ
-from typing import Union
+from typing import Union, Any, Callable
 
 from fastapi import FastAPI, Depends, HTTPException, status, Response, WebSocket, WebSocketDisconnect, Header
-from fastapi.responses import StreamingResponse
 from sqlalchemy import or_, and_
 from sqlalchemy.orm import Session
 from yt_dlp.utils import DownloadError
 
+import app.blobgc as blobgc
+import app.changelog as changelog
 import app.crud as crud
+import app.fastjson as fastjson
 import app.models as models
 import app.schemas as schemas
-from app.db import SessionLocal, engine
-from app.extractor import get_data
+import app.storage as storage
+from app.blobcache import BlobCache
+from app.blobio import blob_io
+from app.db import SessionLocal, ReadSessionLocal, engine, run_db
+from app.extractor import get_cached_data, thumb_cache, audio_cache, audio_mime, image_mime, clear_extractions, \
+    blob_store
 from app.jobmanager import jobs, get_job, delete_job
 from app.models import Base
+from app.responsecache import ResponseCache
+from app.responses import file_response, is_not_modified, not_modified, if_range_matches
+from app.storage import blob_key
 
 app = FastAPI()
 Base.metadata.create_all(bind=engine)
 
+response_cache = ResponseCache(int(environ.get('response_cache_mb', 64)) * 1024 * 1024)
+
+# Library responses are built straight from query rows. json_mode 'pydantic' converts the models to schemas instead.
+json_mode = environ.get('json_mode', 'rows')
+
 if environ.get('devmode'):
     pass
 
@@ -36,6 +50,47 @@ def getdb():
         db.close()
 
 
+# Dependency for routes that only read, which use the read only connections
+def getreaddb():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Dependency for the library version, read from the change log so every worker agrees on it.
+# Shares the route's read session, as dependencies are only run once per request.
+async def getLibraryVersion(db: Session = Depends(getreaddb)) -> int:
+    return await run_db(changelog.libraryVersion, db)
+
+
+# Json responses only change when the library does, so they are validated by the library version.
+# Returns a 304 response if the client is up-to-date, otherwise adds the validators to the response.
+# There's no Last-Modified, as the library can change more than once within its one second resolution.
+def checkLibraryValidators(response: Response, if_none_match: str | None, version: int):
+    validators = {
+        "ETag": f'"{version}"',
+        "Cache-Control": "no-cache"
+    }
+    if is_not_modified(if_none_match, validators["ETag"]):
+        return not_modified(validators)
+
+    response.headers.update(validators)
+    return None
+
+
+# Library responses are encoded once per library version and then served as bytes from the response cache.
+# build runs on the db thread and returns rows or schemas, which are encoded there too, the same way fastapi would.
+# version is read before building, so a body that raced with a commit is at least as new as its version.
+async def cachedLibraryResponse(key: str, response: Response, version: int, build: Callable[[], Any]) -> Response:
+    body = response_cache.get(key, version)
+    if body is None:
+        body = await run_db(lambda: fastjson.dumps(build()))
+        response_cache.put(key, version, body)
+    return Response(body, media_type="application/json", headers=dict(response.headers))
+
+
 def getSongFromDb(songid: int, db: Session):
     dbsong: models.Song = db.query(models.Song).get(songid)
     if not dbsong:
@@ -60,92 +115,261 @@ async def pong():
     return {'ping': 'pong'}
 
 
-@app.get('/playlist', response_model=Union[list[schemas.ShallowPlaylist], list[schemas.Playlist]])
-async def getPlaylists(shallow: bool = True, db=Depends(getdb)):
-    playlistModels: list[models.Playlist] = db.query(models.Playlist).all()
-    if shallow:
-        response = [schemas.ShallowPlaylist.from_orm(x) for x in playlistModels]
-    else:
-        response = [schemas.Playlist.from_orm(x) for x in playlistModels]
+@app.get('/stats')
+async def getStats():
+    return {
+        'blob_cache': {
+            'thumbnail': thumb_cache.stats(),
+            'audio': audio_cache.stats(),
+        },
+        'downloads': crud.song_downloads.stats(),
+        'download_scheduler': crud.download_scheduler.stats(),
+        'blob_gc': blobgc.gc_stats,
+        'blob_io': blob_io.stats(),
+        'response_cache': response_cache.stats(),
+        'changes': changelog.changes_stats,
+    }
+
+
+# normalized returns the whole library as a schemas.Library instead, and ignores shallow
+@app.get('/playlist', response_model=Union[list[schemas.ShallowPlaylist], list[schemas.Playlist], schemas.Library])
+async def getPlaylists(response: Response, shallow: bool = True, normalized: bool = False,
+                       if_none_match: str | None = Header(default=None),
+                       db: Session = Depends(getreaddb), version: int = Depends(getLibraryVersion)):
+    notModified = checkLibraryValidators(response, if_none_match, version)
+    if notModified:
+        return notModified
+
+    if normalized:
+        return await cachedLibraryResponse("playlists?normalized", response, version, lambda: crud.getLibrary(db))
 
-    return response
+    def query():
+        if json_mode == 'rows':
+            return crud.getPlaylistRows(db, shallow)
+
+        playlistModels = crud.getPlaylists(db, shallow)
+        if shallow:
+            return [schemas.ShallowPlaylist.from_orm(x) for x in playlistModels]
+        else:
+            return [schemas.Playlist.from_orm(x) for x in playlistModels]
+
+    return await cachedLibraryResponse(f"playlists?shallow={shallow}", response, version, query)
 
 
 @app.get('/playlist/{playlistid}', response_model=schemas.Playlist)
-async def getPlaylist(playlistid: int, db: Session = Depends(getdb)):
-    playlist = db.query(models.Playlist).get(playlistid)
-    if playlist is None:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested playlist does not exist.")
-    return playlist
+async def getPlaylist(playlistid: int, response: Response,
+                      if_none_match: str | None = Header(default=None),
+                      db: Session = Depends(getreaddb), version: int = Depends(getLibraryVersion)):
+    notModified = checkLibraryValidators(response, if_none_match, version)
+    if notModified:
+        return notModified
+
+    def query():
+        if json_mode == 'rows':
+            playlists = crud.getPlaylistRows(db, shallow=False, playlistid=playlistid)
+            playlist = playlists[0] if playlists else None
+        else:
+            playlist = crud.getPlaylist(playlistid, db)
+        if playlist is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested playlist does not exist.")
+        return playlist if json_mode == 'rows' else schemas.Playlist.from_orm(playlist)
+
+    return await cachedLibraryResponse(f"playlist/{playlistid}", response, version, query)
 
 
 @app.put('/playlist/{playlistid}', response_model=schemas.Playlist)
 async def putPlaylist(playlistid: int, newplaylist: schemas.PlaylistIn, db: Session = Depends(getdb)):
-    playlistmodel: models.Playlist = db.query(models.Playlist).get(playlistid)
-    if playlistmodel is None:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested playlist does not exist.")
+    def update():
+        playlistmodel: models.Playlist = db.query(models.Playlist).get(playlistid)
+        if playlistmodel is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested playlist does not exist.")
 
-    if playlistmodel.title is not None:
-        playlistmodel.title = newplaylist.title
+        if playlistmodel.title is not None:
+            playlistmodel.title = newplaylist.title
 
-    if newplaylist.songs is not None:
-        try:
-            crud.addSongsToPlaylist(playlistmodel.id, newplaylist.songs, db, clear=True)
-        except ValueError:
-            raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested songs not found.")
+        if newplaylist.songs is not None:
+            try:
+                crud.addSongsToPlaylist(playlistmodel.id, newplaylist.songs, db, clear=True)
+            except ValueError:
+                raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested songs not found.")
 
-    db.commit()
-    return playlistmodel
+        db.commit()
+        return schemas.Playlist.from_orm(crud.getPlaylist(playlistid, db))
+
+    return await run_db(update)
 
 
 @app.post('/playlist', response_model=schemas.Playlist)
 async def postPlaylist(playlist: schemas.PlaylistIn, db: Session = Depends(getdb)):
-    if db.query(models.Playlist).filter_by(title=playlist.title).first() is not None:
-        raise HTTPException(status.HTTP_409_CONFLICT, f"Playlist with title {playlist.title} already exists.")
+    def create():
+        if db.query(models.Playlist).filter_by(title=playlist.title).first() is not None:
+            raise HTTPException(status.HTTP_409_CONFLICT, f"Playlist with title {playlist.title} already exists.")
 
-    if playlist.songs is None:
-        playlist.songs = []
+        if playlist.songs is None:
+            playlist.songs = []
 
-    found_songs = db.query(models.Song).filter(models.Song.id.in_(playlist.songs)).all()
+        found_songs = db.query(models.Song).filter(models.Song.id.in_(playlist.songs)).all()
 
-    newPlaylist = models.Playlist(
-        title=playlist.title,
-    )
+        newPlaylist = models.Playlist(
+            title=playlist.title,
+        )
 
-    newPlaylist.songs = [models.PlaylistSong(
-        song=song,
-        playlist=newPlaylist,
-        dateadded=datetime.now()
-    ) for song in found_songs]
+        newPlaylist.songs = [models.PlaylistSong(
+            song=song,
+            playlist=newPlaylist,
+            dateadded=datetime.now()
+        ) for song in found_songs]
 
-    db.add(newPlaylist)
-    db.commit()
-    return newPlaylist
+        db.add(newPlaylist)
+        db.commit()
+        return schemas.Playlist.from_orm(crud.getPlaylist(newPlaylist.id, db))
+
+    return await run_db(create)
 
 
 @app.delete('/playlist/{playlist_id}')
 async def deletePlaylist(playlist_id: int, db: Session = Depends(getdb)):
-    playlist = db.get(models.Playlist, playlist_id)
-    if playlist is None:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "Could not find provided playlist")
+    def delete():
+        playlist = db.get(models.Playlist, playlist_id)
+        if playlist is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Could not find provided playlist")
+
+        db.delete(playlist)
+        db.commit()
 
-    db.delete(playlist)
-    db.commit()
+    await run_db(delete)
     return "Deletion successful"
 
 
+# Without since, returns just the current version to start from
+@app.get('/changes', response_model=schemas.LibraryChanges, responses={
+    410: {
+        "model": schemas.ExceptionResponse,
+        "description": "Changes since then have been compacted away, so the whole library has to be fetched."
+    }
+})
+async def getChanges(since: int | None = None, db: Session = Depends(getreaddb)):
+    changes = await run_db(changelog.changesSince, db, since)
+    if changes is None:
+        raise HTTPException(status.HTTP_410_GONE, "Changes since this version are no longer available.")
+    return changes
+
+
 @app.get('/song', response_model=list[schemas.Song])
-async def getSongs(db: Session = Depends(getdb)):
-    return db.query(models.Song).all()
+async def getSongs(response: Response,
+                   if_none_match: str | None = Header(default=None),
+                   db: Session = Depends(getreaddb), version: int = Depends(getLibraryVersion)):
+    notModified = checkLibraryValidators(response, if_none_match, version)
+    if notModified:
+        return notModified
+
+    def query():
+        if json_mode == 'rows':
+            return crud.getSongRows(db)
+        return [schemas.Song.from_orm(song) for song in crud.getSongs(db)]
+
+    return await cachedLibraryResponse("songs", response, version, query)
 
 
 @app.get('/song/{songid}', response_model=schemas.Song)
-async def getSong(songid: int, db: Session = Depends(getdb)):
-    song = db.query(models.Song).get(songid)
-    if song is None:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested song does not exist.")
+async def getSong(songid: int, response: Response,
+                  if_none_match: str | None = Header(default=None),
+                  db: Session = Depends(getreaddb), version: int = Depends(getLibraryVersion)):
+    notModified = checkLibraryValidators(response, if_none_match, version)
+    if notModified:
+        return notModified
+
+    def query():
+        song = crud.getSong(songid, db)
+        if song is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Requested song does not exist.")
+        return schemas.Song.from_orm(song)
+
+    return await run_db(query)
+
+
+# Never downloads the song, so clients can check sources without triggering downloads
+@app.head('/song/{songid}/src', responses={
+    204: {
+        "description": "Song hasn't been downloaded yet, so requesting the source will download it first"
+    },
+    **getSongResponses
+})
+async def headSongSource(songid: int, if_none_match: str | None = Header(default=None),
+                         db: Session = Depends(getreaddb)):
+    dbsong = await run_db(getSongFromDb, songid, db)
+    if dbsong.disabled:
+        raise HTTPException(status.HTTP_410_GONE, "Song is disabled due to lack of a source")
+
+    if not dbsong.data_uuid:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+    validators = {"ETag": f'"{dbsong.data_uuid}"', "Cache-Control": "no-cache"}
+    if is_not_modified(if_none_match, validators["ETag"]):
+        return not_modified(validators)
+
+    size = dbsong.datasize
+    if size is None:  # Downloaded before sizes were stored
+        stat = await blob_io.run('stat', blob_store.stat, blob_key(dbsong.data_uuid, dbsong.dataext))
+        if stat is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Blob not found")
+        size = stat.size
+
+    return Response(media_type=dbsong.datamime or audio_mime(dbsong.dataext), headers={
+        **validators,
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(size),
+    })
 
-    return song
+
+# Availability of many songs' sources in one request, only from what is stored in the db.
+# Songs that don't exist are left out.
+@app.post('/song/probe', response_model=list[schemas.SongSourceProbe])
+async def probeSongSources(songids: list[int], db: Session = Depends(getreaddb)):
+    def query(ids: list[int]):
+        return db.query(models.Song.id, models.Song.disabled, models.Song.data_uuid, models.Song.dataext,
+                        models.Song.datasize, models.Song.datamime) \
+            .filter(models.Song.id.in_(ids)) \
+            .all()
+
+    probes = []
+    for i in range(0, len(songids), 500):  # Stay under sqlite's limit on query parameters
+        rows = await run_db(query, songids[i:i + 500])
+
+        probes += [schemas.SongSourceProbe(
+            id=row.id,
+            available=bool(row.data_uuid and row.dataext) and not row.disabled,
+            disabled=row.disabled,
+            size=row.datasize,
+            mime=row.datamime or (audio_mime(row.dataext) if row.dataext else None)
+        ) for row in rows]
+
+    return probes
+
+
+# Serves a blob from the cache if it's there, otherwise straight from its file, or streamed from the store
+# if it isn't kept on this machine.
+async def blobResponse(uuid: str, ext: str, cache: BlobCache, mime: str, request_range: str | None, headers: dict,
+                       size: int = None) -> Response:
+    key = blob_key(uuid, ext)
+    if blob_store.migrating:  # Looking in the old flat layout too touches the disk
+        path = await blob_io.run('stat', blob_store.local_path, key)
+    else:
+        path = blob_store.local_path(key)
+    # The same response as BlobResponse gives when the file goes missing before it's sent
+    if size is None:
+        stat = await blob_io.run('stat', blob_store.stat, key)
+        if stat is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Blob not found")
+        size = stat.size
+
+    try:
+        data = await get_cached_data(uuid, ext, cache, size)
+    except FileNotFoundError:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Blob not found")
+
+    return file_response(path, mime, request_range, headers=headers, data=data, size=size,
+                         reader=partial(blob_store.get_range, key))
 
 
 @app.get('/song/{songid}/src', responses={
@@ -153,6 +377,13 @@ async def getSong(songid: int, db: Session = Depends(getdb)):
         "content": {"audio/{requested data extension}": {}},
         "description": "Stream back the requested song",
     },
+    206: {
+        "content": {"audio/{requested data extension}": {}, "multipart/byteranges": {}},
+        "description": "Stream back the requested byte ranges of the song",
+    },
+    416: {
+        "description": "Requested range is outside of the song"
+    },
     469: {
         "model": schemas.ExceptionResponse,
         "description": "Could not download"
@@ -161,8 +392,10 @@ async def getSong(songid: int, db: Session = Depends(getdb)):
 })
 async def getSongSource(songid: int,
                         request_range: str | None = Header(default=None, alias="Range"),
+                        if_none_match: str | None = Header(default=None),
+                        if_range: str | None = Header(default=None),
                         db: Session = Depends(getdb)):
-    dbsong = getSongFromDb(songid, db)
+    dbsong = await run_db(getSongFromDb, songid, db)
     if dbsong.disabled:
         raise HTTPException(status.HTTP_410_GONE, "Song is disabled due to lack of a source")
 
@@ -172,43 +405,28 @@ async def getSongSource(songid: int,
         except DownloadError as e:
             raise HTTPException(469, "Could not download")
 
-    song_data = get_data(dbsong.data_uuid, dbsong.dataext)
-
-    data_length = len(song_data)
+    # Blobs are never modified, so the uuid identifies the exact bytes of the source
+    validators = {"ETag": f'"{dbsong.data_uuid}"', "Cache-Control": "no-cache"}
+    if is_not_modified(if_none_match, validators["ETag"]):
+        return not_modified(validators)
 
-    # OLD COMMENT, REFERENCES CONTENTS OF FIRST BRANCH OF IF STATEMENT
-    # So that the audio player can seek to given times
-    # If 206 is not returned then (on chromium at least), audio player cannot seek
-    # Content length is the total length of the content
-    # Content range (i assume) is the range of bytes of this response, used by the player
-    #   to construct audio from chunks, but here we just send it all at once.
-    #       it might be better to send it chunked but i cba to write that code rn
+    if not if_range_matches(if_range, validators["ETag"]):
+        request_range = None
 
-    print(request_range)
+    mime = dbsong.datamime or audio_mime(dbsong.dataext)
 
-    if request_range is None or not request_range.startswith("bytes="):
-        return StreamingResponse(io.BytesIO(song_data), media_type=f"audio/{dbsong.dataext}", status_code=206, headers={
-            "Accept-Ranges": 'bytes',
-            "Content-Length": str(data_length),
-            "Content-Range": f"bytes 0-{str(data_length)}/{str(data_length)}"
-        })
-    else:
-        start_byte = int(request_range[6:-1])
-        song_data = song_data[start_byte:]
-        return StreamingResponse(io.BytesIO(song_data), media_type=f"audio/{dbsong.dataext}", status_code=206, headers={
-            "Accept-Ranges": 'bytes',
-            "Content-Length": str(data_length),
-            "Content-Range": f"bytes {str(start_byte)}-{str(data_length)}/{str(data_length)}"
-        })
+    # 206 must be returned for range requests, otherwise (on chromium at least) the audio player cannot seek.
+    return await blobResponse(dbsong.data_uuid, dbsong.dataext, audio_cache, mime, request_range, validators,
+                              dbsong.datasize)
 
 
 @app.get('/song/{songid}/thumb', response_model=str)
 async def getSongThumb(songid: int, db: Session = Depends(getdb)):
-    dbsong = getSongFromDb(songid, db)
+    dbsong = await run_db(getSongFromDb, songid, db)
     if not dbsong:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Not a valid song")
 
-    if not dbsong.thumbnail:
+    if not await run_db(lambda: dbsong.thumbnail):
         result = await crud.getSongThumb(dbsong, db)
         if not result:
             raise HTTPException(469, "Could not download")
@@ -217,33 +435,43 @@ async def getSongThumb(songid: int, db: Session = Depends(getdb)):
     if ext.startswith('.'):  # Because some extensions in db might start with .
         ext = ext[1:]
         thumbnail.ext = ext
-        db.commit()
+        await run_db(db.commit)
 
     # Don't do ranges, could have been the cause of the weird half image loading issue that btecifyv3 had?
     return str(thumbnail.id)
 
 
 @app.get('/thumb/{thumbid}')
-async def getThumb(thumbid: int, db: Session = Depends(getdb)):
-    thumb = db.get(models.Thumbnail, thumbid)
+async def getThumb(thumbid: int, if_none_match: str | None = Header(default=None), db: Session = Depends(getreaddb)):
+    thumb = await run_db(db.get, models.Thumbnail, thumbid)
     if thumb is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Thumbnail not found")
 
-    ext = thumb.ext
-    data = get_data(thumb.data_uuid, thumb.ext)
-
-    return StreamingResponse(io.BytesIO(data), media_type=f"image/{ext}", headers={
+    validators = {
+        "ETag": f'"{thumb.hash}"',
         "cache-control": "public, max-age=31536000"  # Cache for one year
-    })
+    }
+    if is_not_modified(if_none_match, validators["ETag"]):
+        return not_modified(validators)
+
+    mime = thumb.mime or image_mime(thumb.ext)
+
+    # Don't do ranges, could have been the cause of the weird half image loading issue that btecifyv3 had?
+    return await blobResponse(thumb.data_uuid, thumb.ext, thumb_cache, mime, None,
+                              {"Accept-Ranges": "none", **validators}, thumb.size)
 
 
 @app.post('/song', response_model=schemas.Song)
 async def postSong(song: schemas.SongIn, playlists: list[int], response: Response, db: Session = Depends(getdb)):
-    oldSong = db.query(models.Song).filter(models.Song.weburl == song.weburl).first()
+    def addExisting():
+        oldSong = db.query(models.Song).filter(models.Song.weburl == song.weburl).first()
+        if oldSong is not None:
+            for playlist_id in playlists:
+                crud.addSongsToPlaylist(playlist_id, [oldSong.id], db)
+            return schemas.Song.from_orm(oldSong)
+
+    oldSong = await run_db(addExisting)
     if oldSong is not None:
-        for playlist_id in playlists:
-            crud.addSongsToPlaylist(playlist_id, [oldSong.id], db)
-
         response.status_code = status.HTTP_204_NO_CONTENT
         return oldSong
 
@@ -251,12 +479,14 @@ async def postSong(song: schemas.SongIn, playlists: list[int], response: Respons
     if not song:
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, "Could not download song")
 
-    return song
+    return await run_db(schemas.Song.from_orm, song)
 
 
-@app.post('/fullsync')
+@app.post('/fullsync', response_model=schemas.SyncReport)
 async def fullSync(syncdata: schemas.FullSync, db: Session = Depends(getdb)):
-    crud.fullSync(syncdata, db)
+    report, released_blobs = await run_db(crud.fullSync, syncdata, db)
+    await crud.releaseAudio(db, released_blobs)
+    return report
 
 
 @app.post('/fulldownload', response_model=str)
@@ -267,8 +497,8 @@ async def fullDownload():
         db.close()
 
     try:
-        allSongs = db.query(models.Song).filter(
-            and_(or_(models.Song.data_uuid == None, models.Song.dataext == None), models.Song.disabled == False)).all()
+        allSongs = await run_db(lambda: db.query(models.Song).filter(
+            and_(or_(models.Song.data_uuid == None, models.Song.dataext == None), models.Song.disabled == False)).all())
         job_id = await crud.downloadExistingSongsJob(allSongs, db, finished)
         return job_id
     except Exception as e:
@@ -276,6 +506,22 @@ async def fullDownload():
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
 
 
+# Records the size, mime type and checksum of blobs downloaded before they were stored in the db
+@app.post('/backfillmeta', response_model=str)
+async def backfillBlobMetadata():
+    db: Session = SessionLocal()
+
+    def finished():
+        db.close()
+
+    try:
+        job_id = await crud.backfillBlobMetadataJob(db, finished)
+        return job_id
+    except Exception as e:
+        finished()
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+
 @app.websocket('/job/{job_id}')
 async def job_websocket(websocket: WebSocket, job_id: str):
     job = get_job(job_id)
@@ -287,8 +533,9 @@ async def job_websocket(websocket: WebSocket, job_id: str):
     try:
         while True:
             client_data = await websocket.receive_text()
+            queued = crud.download_scheduler.queued(job_id)
             await websocket.send_json(
-                schemas.Job(**job.__dict__).dict())  # Make new schema with just important info from just
+                schemas.Job(**job.__dict__, queued=queued).dict())  # Make new schema with just important info from just
             if job.status:
                 # Close websocket when job completion is sent.
                 await websocket.close(code=3005)
@@ -299,6 +546,11 @@ async def job_websocket(websocket: WebSocket, job_id: str):
         pass
 
 
+@app.on_event('startup')
+async def clearExtractions():
+    clear_extractions()
+
+
 @app.on_event('startup')
 async def clearJobTask():
     async def task():
@@ -318,6 +570,55 @@ async def clearJobTask():
     asyncio.create_task(task())
 
 
+@app.on_event('startup')
+async def loopLagTask():
+    asyncio.create_task(blob_io.monitor_loop_lag())
+
+
+@app.on_event('startup')
+async def migrateBlobsTask():
+    if blob_store.migrating:
+        asyncio.create_task(storage.migrate_online(blob_store))
+
+
+@app.on_event('startup')
+async def blobGCTask():
+    if blobgc.gc_interval <= 0:
+        return
+
+    async def task():
+        while True:
+            await asyncio.sleep(blobgc.gc_interval)
+            db = SessionLocal()
+            try:
+                await blobgc.collectGarbage(db)
+            except Exception as e:
+                print("Blob gc failed:", e)
+            finally:
+                db.close()
+
+    asyncio.create_task(task())
+
+
+@app.on_event('startup')
+async def changesCompactionTask():
+    if changelog.changes_interval <= 0:
+        return
+
+    async def task():
+        while True:
+            await asyncio.sleep(changelog.changes_interval)
+            db = SessionLocal()
+            try:
+                await run_db(changelog.compactChanges, db)
+            except Exception as e:
+                print("Change log compaction failed:", e)
+            finally:
+                db.close()
+
+    asyncio.create_task(task())
+
+
 print("http://127.0.0.1:8000/docs")
 
 if __name__ == "__main__":
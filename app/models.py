@@ -25,10 +25,15 @@ class Song(Base):
     disabled = Column(Boolean, nullable=False, default=False)
 
     extractor = Column(String, nullable=True)
-    data_uuid = Column(String, nullable=True)
+    data_uuid = Column(String, nullable=True, index=True)  # Indexed for counting the songs sharing a blob
     dataext = Column(String, nullable=True)
     weburl = Column(String, nullable=True, unique=True)
 
+    # Recorded when the source is downloaded, so it can be served without touching the file first
+    datasize = Column(Integer, nullable=True)
+    datamime = Column(String, nullable=True)
+    datahash = Column(String, nullable=True)
+
     thumb_id = Column(String, ForeignKey('thumbnail.id'), nullable=True)
     thumbnail = relationship("Thumbnail")
 
@@ -47,6 +52,8 @@ class Thumbnail(Base):
     hash = Column(String, nullable=False)
     data_uuid = Column(String, nullable=False)
     ext = Column(String, nullable=False)
+    size = Column(Integer, nullable=True)
+    mime = Column(String, nullable=True)
 
 
 class Album(Base):
@@ -79,6 +86,26 @@ class Playlist(Base):
     songs = relationship('PlaylistSong', back_populates='playlist', cascade="all, delete, delete-orphan")
 
 
+# Log of what changed in the library, for clients to catch up with (see changelog).
+# Ids are the library's change versions, autoincrement so they're never reused after compaction deletes entries.
+class Change(Base):
+    __tablename__ = "change"
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)  # song, playlist or membership
+    entity_id = Column(Integer, nullable=False)  # The song or playlist, or the playlist of a membership
+    song_id = Column(Integer, nullable=True)  # The song of a membership
+    date = Column(DateTime, nullable=False)
+
+
+# Changes up to and including through have been compacted away, so clients behind it have to fetch everything
+class ChangeCompaction(Base):
+    __tablename__ = "change_compaction"
+    id = Column(Integer, primary_key=True)
+    through = Column(Integer, nullable=False)
+    date = Column(DateTime, nullable=False)
+
+
 class User(Base):
     __tablename__ = "user"
     id = Column(Integer, primary_key=True)
@@ -0,0 +1,39 @@
+from app.blobcache import BlobCache
+
+
+# Encoded json bodies of library responses, valid for one library version.
+# Every change to the library is logged, which bumps the version, so a new version empties the cache instead of
+# each write path having to work out which responses it affects.
+class ResponseCache:
+    def __init__(self, budget: int):
+        self.version = -1
+        self.bodies = BlobCache(budget)
+        self.invalidations = 0
+
+    def get(self, key: str, version: int) -> bytes | None:
+        if version != self.version:
+            self.bodies.misses += 1
+            return None
+        return self.bodies.get(key)
+
+    # version is the one read before building the body, so a body that raced with a commit is never kept for newer
+    def put(self, key: str, version: int, body: bytes):
+        if version < self.version:
+            return
+        if version > self.version:
+            self.clear()
+            self.version = version
+        self.bodies.put(key, body)
+
+    def clear(self):
+        if self.bodies.entries:
+            self.invalidations += 1
+        self.bodies.clear()
+        self.version = -1
+
+    def stats(self) -> dict:
+        return {
+            **self.bodies.stats(),
+            "version": self.version,
+            "invalidations": self.invalidations,
+        }
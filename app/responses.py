@@ -0,0 +1,265 @@
+import mmap
+import os
+from pathlib import Path
+from typing import Callable, Iterator
+from uuid import uuid4
+
+from fastapi import Response, status
+from fastapi.responses import JSONResponse
+
+from app.blobio import blob_io
+
+CHUNK_SIZE = 64 * 1024  # Size of each body message when streaming a blob
+PREFAULT_SIZE = 1024 * 1024  # How much of a mapped file is asked to be read in at a time
+MAX_RANGES = 16  # More ranges than this in one request and the header is ignored, to stop abuse
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+# Returns a list of inclusive (start, end) byte ranges, or None if the whole file should be sent.
+# Follows RFC 7233: a syntactically invalid header is ignored, but a valid one that misses the file entirely is a 416.
+def parse_range(range_header: str | None, size: int) -> list[tuple[int, int]] | None:
+    if range_header is None:
+        return None
+
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if len(specs) == 0 or len(specs) > MAX_RANGES:
+        return None
+
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+            return None
+
+        if not first:  # Suffix range, bytes=-N is the last N bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) == 0:
+        raise RangeNotSatisfiable(range_header, size)
+
+    return ranges
+
+
+# Weak comparison, as If-None-Match requires.
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == '*':
+        return True
+
+    etag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+# Whether the client's cached copy is still valid, so a 304 can be sent.
+def is_not_modified(if_none_match: str | None, etag: str) -> bool:
+    return if_none_match is not None and etag_matches(if_none_match, etag)
+
+
+# Strong comparison, a weak etag or a date in If-Range means the whole blob is sent instead of the range.
+def if_range_matches(if_range: str | None, etag: str) -> bool:
+    if if_range is None:
+        return True
+    return not etag.startswith('W/') and if_range.strip() == etag
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+# One part of a blob response body, either literal bytes (multipart headers) or an inclusive byte range of the blob.
+Segment = bytes | tuple[int, int]
+
+
+# Returns the inclusive byte range start to end of a blob, in chunks
+Reader = Callable[[int, int], Iterator[bytes]]
+
+
+# Asks the kernel to read bytes start to end of the file into the page cache, so sending them from a map doesn't wait
+# on the disk. Touching the mapped pages would do the same, but holds the GIL (and so blocks the event loop) while
+# they're read, and reading them with pread would copy them. Where there's no fadvise the pages fault in as sent.
+def prefault(fd: int, start: int, end: int):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, start, end + 1 - start, os.POSIX_FADV_WILLNEED)
+
+
+# Sends blob ranges without copying them through python.
+# Blobs already in memory are sent as memoryview slices of the cached bytes.
+# Otherwise, if the ASGI server supports the zerocopy extension it is handed the file so it can use os.sendfile,
+# and if it doesn't the file is mmapped and sent as memoryview slices, so only the kernel's page cache holds the data.
+# All blocking file access (opening, faulting in mapped pages, reading from a store) happens on the blob io pool.
+
+class BlobResponse(Response):
+    def __init__(self, path: Path | None, segments: list[Segment], status_code: int = 200, headers: dict = None,
+                 media_type: str = None, data: bytes = None, reader: Reader = None):
+        self.path = path
+        self.data = data
+        self.reader = reader
+        self.segments = segments
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope, receive, send) -> None:
+        # Opened before anything is sent, so a blob deleted since the response was made can still get an error status
+        f = None
+        if self.data is None and self.path is not None:
+            try:
+                f = await blob_io.run('open', self.path.open, "rb")
+            except FileNotFoundError:
+                await JSONResponse({"detail": "Blob not found"}, status.HTTP_404_NOT_FOUND)(scope, receive, send)
+                return
+
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        try:
+            if self.data is not None:
+                await self.send_view(memoryview(self.data), send)
+            elif f is None:
+                await self.send_stream(send)
+            elif "http.response.zerocopy" in scope.get("extensions", {}):
+                await self.send_zerocopy(f, send)
+            else:
+                await self.send_mmap(f, send)
+        finally:
+            if f is not None:
+                f.close()
+
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        if self.background is not None:
+            await self.background()
+
+    async def send_zerocopy(self, f, send):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment, "more_body": True})
+            else:
+                start, end = segment
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": f,
+                    "offset": start,
+                    "count": end - start + 1,
+                    "more_body": True
+                })
+
+    async def send_mmap(self, f, send):
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files can't be mapped, and have nothing to send anyway
+            await self.send_view(memoryview(b""), send)
+            return
+
+        await self.send_view(memoryview(mapped), send, f.fileno())
+
+        # The server may still hold slices in its write buffer, in which case the map is closed by the gc instead.
+        try:
+            mapped.close()
+        except BufferError:
+            pass
+
+    async def send_stream(self, send):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment, "more_body": True})
+                continue
+
+            start, end = segment
+            if end < start:  # Empty blob
+                continue
+            chunks = self.reader(start, end)
+            try:
+                while (chunk := await blob_io.run('stream', next, chunks, None)) is not None:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            finally:
+                if hasattr(chunks, 'close'):
+                    await blob_io.run('close', chunks.close)
+
+    # Pass the file's fd if the view is of a mapped file, so its pages are read in on the blob io pool before being sent
+    async def send_view(self, view: memoryview, send, fd: int = None):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment, "more_body": True})
+                continue
+
+            start, end = segment
+            for window in range(start, end + 1, PREFAULT_SIZE):
+                window_end = min(window + PREFAULT_SIZE, end + 1)
+                if fd is not None:
+                    await blob_io.run('prefault', prefault, fd, window, window_end - 1)
+                for offset in range(window, window_end, CHUNK_SIZE):
+                    chunk = view[offset:min(offset + CHUNK_SIZE, window_end)]
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+# Serves a blob, honouring the Range header.
+# If the blob isn't already in memory as data, the file is never read into memory,
+# so seeking through long songs doesn't copy the whole file.
+# Blobs without a file (path is None) are streamed from the reader instead, and need their size passed.
+# Pass the size if it's known, so that the file doesn't need to be stat'd.
+def file_response(path: Path | None, media_type: str, request_range: str | None, headers: dict = None,
+                  data: bytes = None, size: int = None, reader: Reader = None) -> Response:
+    if data is not None:
+        size = len(data)
+    elif size is None:
+        size = path.stat().st_size
+    headers = {"Accept-Ranges": "bytes", **(headers or {})}
+
+    try:
+        ranges = parse_range(request_range, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={
+            **headers,
+            "Content-Range": f"bytes */{size}"
+        })
+
+    if ranges is None:
+        return BlobResponse(path, [(0, size - 1)], media_type=media_type, data=data, reader=reader, headers={
+            **headers,
+            "Content-Length": str(size)
+        })
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        return BlobResponse(path, [(start, end)], media_type=media_type, data=data, reader=reader,
+                            status_code=status.HTTP_206_PARTIAL_CONTENT, headers={
+                **headers,
+                "Content-Length": str(end - start + 1),
+                "Content-Range": f"bytes {start}-{end}/{size}"
+            })
+
+    boundary = uuid4().hex
+    segments = []
+    for start, end in ranges:
+        segments.append(
+            f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode())
+        segments.append((start, end))
+        segments.append(b"\r\n")
+    segments.append(f"--{boundary}--\r\n".encode())
+
+    content_length = sum(len(segment) if isinstance(segment, bytes) else segment[1] - segment[0] + 1
+                         for segment in segments)
+
+    return BlobResponse(path, segments, media_type=f"multipart/byteranges; boundary={boundary}", data=data,
+                        reader=reader, status_code=status.HTTP_206_PARTIAL_CONTENT, headers={
+            **headers,
+            "Content-Length": str(content_length)
+        })
@@ -0,0 +1,118 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Hashable
+
+# Priority classes, lower runs first
+INTERACTIVE = 0  # Someone is waiting to play the song
+THUMBNAIL = 1
+BULK = 2  # Backfills such as /fulldownload
+
+PRIORITIES = [INTERACTIVE, THUMBNAIL, BULK]
+
+
+@dataclass
+class Waiter:
+    future: asyncio.Future
+    priority: int
+    group: Hashable
+    key: Hashable
+
+
+# Limits how many downloads run at once.
+# Waiting downloads are started highest priority first, and within a priority the groups (usually jobs)
+# take turns, so one huge job can't stop a smaller one from making progress.
+class DownloadScheduler:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.running = 0
+        # For each priority, the queue of waiters of each group, in the order the groups take turns
+        self.waiting: list[dict[Hashable, deque[Waiter]]] = [{} for _ in PRIORITIES]
+        self.keyed: dict[Hashable, Waiter] = {}
+
+    @asynccontextmanager
+    async def slot(self, priority: int = INTERACTIVE, group: Hashable = None, key: Hashable = None):
+        await self.acquire(priority, group, key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: int, group: Hashable = None, key: Hashable = None):
+        if self.running < self.workers and self.queued() == 0:
+            self.running += 1
+            return
+
+        waiter = Waiter(asyncio.get_event_loop().create_future(), priority, group, key)
+        self.waiting[priority].setdefault(group, deque()).append(waiter)
+        if key is not None:
+            self.keyed[key] = waiter
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():  # Was given a slot just as it was cancelled
+                self.release()
+            else:
+                self.remove(waiter)
+            raise
+
+    def release(self):
+        self.running -= 1
+        while self.running < self.workers:
+            waiter = self.next_waiter()
+            if waiter is None:
+                return
+            self.running += 1
+            waiter.future.set_result(None)
+
+    def next_waiter(self) -> Waiter | None:
+        for groups in self.waiting:
+            if groups:
+                group = next(iter(groups))
+                queue = groups.pop(group)
+                waiter = queue.popleft()
+                if queue:
+                    groups[group] = queue  # Back of the line for this group's next download
+                if self.keyed.get(waiter.key) is waiter:
+                    del self.keyed[waiter.key]
+                return waiter
+        return None
+
+    def remove(self, waiter: Waiter):
+        groups = self.waiting[waiter.priority]
+        queue = groups.get(waiter.group)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del groups[waiter.group]
+        if self.keyed.get(waiter.key) is waiter:
+            del self.keyed[waiter.key]
+
+    # Moves a waiting download up to a higher priority, e.g. when someone wants to play a song that's still queued
+    # in a bulk download.
+    def promote(self, key: Hashable, priority: int):
+        waiter = self.keyed.get(key)
+        if waiter is None or waiter.priority <= priority:
+            return
+
+        self.remove(waiter)
+        waiter.priority = priority
+        self.waiting[priority].setdefault(waiter.group, deque()).append(waiter)
+        self.keyed[key] = waiter
+
+    def queued(self, group: Hashable = ...) -> int:
+        if group is ...:
+            return sum(len(queue) for groups in self.waiting for queue in groups.values())
+        return sum(len(groups.get(group, ())) for groups in self.waiting)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": {
+                name: sum(len(queue) for queue in self.waiting[priority].values())
+                for name, priority in [("interactive", INTERACTIVE), ("thumbnail", THUMBNAIL), ("bulk", BULK)]
+            },
+        }
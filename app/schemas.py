@@ -26,9 +26,14 @@ class Thumbnail(BaseModel):
 class SongDownload(BaseModel):
     data_uuid: str
     dataext: str
+    datasize: int
+    datamime: str
+    datahash: str
     thumb_uuid: str
     thumbext: str
     thumb_hash: str
+    thumbsize: int
+    thumbmime: str
     info: dict
     extractor: str
 
@@ -118,6 +123,53 @@ class ShallowPlaylist(PlaylistBase):
         getter_dict = ShallowPlaylistGetter
 
 
+# The whole library with each song, artist and album once, referenced by id.
+# Nested playlists repeat a song (and all its memberships) for every playlist it's in.
+class LibrarySong(BaseModel):
+    id: int
+    title: str
+    weburl: str
+    disabled: bool
+    album_id: int | None
+    duration: float | None
+    extractor: str | None
+    artist_id: int | None
+
+    class Config:
+        orm_mode = True
+
+
+class LibraryPlaylist(PlaylistBase):
+    songs: list[tuple[int, datetime]]  # (song id, date added), in playlist order
+
+
+class Library(BaseModel):
+    songs: list[LibrarySong]
+    artists: list[Artist]
+    albums: list[Album]
+    playlists: list[LibraryPlaylist]
+
+
+class Membership(BaseModel):
+    playlist_id: int
+    song_id: int
+    dateadded: datetime
+
+
+# What changed since a client's version, in the same terms as Library. Songs, playlists and memberships are sent as
+# they are now, so memberships that are new to a playlist go at its end.
+class LibraryChanges(BaseModel):
+    version: int
+    songs: list[LibrarySong] = []
+    artists: list[Artist] = []  # Those of the songs
+    albums: list[Album] = []
+    playlists: list[PlaylistBase] = []
+    memberships: list[Membership] = []
+    deleted_songs: list[int] = []
+    deleted_playlists: list[int] = []
+    deleted_memberships: list[tuple[int, int]] = []  # (playlist id, song id)
+
+
 class PlaylistIn(BaseModel):
     title: str
     songs: list[int] | None
@@ -130,6 +182,14 @@ class SongIn(BaseModel):
     artist: str | None
 
 
+class SongSourceProbe(BaseModel):
+    id: int
+    available: bool  # If false, requesting the source will have to download it first
+    disabled: bool
+    size: int | None
+    mime: str | None
+
+
 class ExceptionResponse(BaseModel):
     detail: str
 
@@ -152,8 +212,25 @@ class FullSync(BaseModel):
     playlists: list[PlaylistFullSync]
 
 
+# What a full sync changed
+class SyncReport(BaseModel):
+    songs_added: int = 0
+    songs_updated: int = 0
+    songs_removed: int = 0
+    playlists_added: int = 0
+    playlists_removed: int = 0
+    playlists_reordered: int = 0
+    memberships_added: int = 0
+    memberships_removed: int = 0
+    artists_added: int = 0
+    artists_removed: int = 0
+    albums_added: int = 0
+    albums_removed: int = 0
+
+
 class Job(BaseModel):
     job_id: str
     size: int
     progress: int = 0
     status: bool = False
+    queued: int = 0  # Downloads of this job waiting for the download scheduler
@@ -0,0 +1,36 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+
+# Makes concurrent calls with the same key share one call, instead of each doing the same work.
+# The shared call keeps running if the caller that started it is cancelled, as other callers may still be waiting.
+class SingleFlight:
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.coalesced = 0  # Number of callers that waited on a call started by someone else
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self.calls.get(key)
+        if future is None:
+            self.started += 1
+            future = asyncio.ensure_future(func())
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(future)
+
+    def finished(self, key: Hashable, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            future.exception()  # So it isn't logged as never retrieved if every caller was cancelled
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,337 @@
+import asyncio
+import errno
+import os
+import shutil
+import sys
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from hashlib import md5
+from itertools import islice
+from os import environ
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from app.blobio import blob_io
+
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class BlobStat:
+    key: str
+    size: int
+    modified: float  # Unix time
+
+
+def blob_key(uuid: str, ext: str) -> str:
+    return f"{uuid}.{ext}"
+
+
+# Where blobs are kept. Blobs are named by key, "{uuid}.{ext}", and are never modified once stored.
+# The local store keeps them on disk; the s3 store keeps them in a bucket, so several servers can share them.
+class BlobStore(ABC):
+    migrating = False
+
+    # The blob's file, if the store keeps them on this machine, so it can be served without copying
+    def local_path(self, key: str) -> Path | None:
+        return None
+
+    @abstractmethod
+    def put(self, key: str, data: bytes):
+        ...
+
+    # Stores the file, which is moved or deleted afterwards. The blob counts as modified now, whatever the file's mtime
+    @abstractmethod
+    def put_file(self, key: str, path: Path):
+        ...
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        ...
+
+    # The inclusive byte range start to end, in chunks, without reading it all into memory at once
+    @abstractmethod
+    def get_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def stat(self, key: str) -> BlobStat | None:
+        ...
+
+    @abstractmethod
+    def list(self) -> Iterator[BlobStat]:
+        ...
+
+    # Marks the blob as just modified, so the blob gc counts it as new
+    @abstractmethod
+    def touch(self, key: str):
+        ...
+
+    # Moves the blob aside where list() won't see it, marked as modified now
+    @abstractmethod
+    def quarantine(self, key: str):
+        ...
+
+    @abstractmethod
+    def quarantined(self) -> Iterator[BlobStat]:
+        ...
+
+    @abstractmethod
+    def purge(self, key: str):
+        ...
+
+
+# Keeps blobs on disk. Each blob goes in a shard directory named after the start of the md5 of its uuid,
+# e.g. db/data/3f/{uuid}.{ext}, so no directory grows big enough to slow down lookups and listings.
+# 256 shards keep around 4000 blobs each at a million blobs; more levels only help far beyond that,
+# and make scans slower as most shard directories end up nearly empty (see benchmarks/blob_layout.py).
+# Blobs from before sharding sit directly in the root until they're migrated, and are still found there meanwhile.
+class ShardedLayout(BlobStore):
+    def __init__(self, root: Path, levels: int = 1, width: int = 2, quarantine_dir: Path = None):
+        self.root = root
+        self.levels = levels
+        self.width = width
+        self.quarantine_dir = quarantine_dir or root.parent.joinpath('quarantine')
+        self.migrating = self.has_flat_blobs()
+
+    def shard(self, uuid: str) -> Path:
+        digest = md5(uuid.encode()).hexdigest()
+        return self.root.joinpath(*(digest[i * self.width:(i + 1) * self.width] for i in range(self.levels)))
+
+    # Looks for the blob in the flat layout too while migrating, which touches the disk, so call it on the blob io pool
+    def path(self, uuid: str, ext: str, create: bool = False) -> Path:
+        shard = self.shard(uuid)
+        path = shard.joinpath(blob_key(uuid, ext))
+        if create:
+            shard.mkdir(parents=True, exist_ok=True)
+        elif self.migrating and not path.exists():
+            flat = self.root.joinpath(path.name)
+            if flat.exists():
+                return flat
+        return path
+
+    def key_path(self, key: str, create: bool = False) -> Path:
+        uuid, _, ext = key.rpartition('.')
+        return self.path(uuid, ext, create)
+
+    def local_path(self, key: str) -> Path | None:
+        return self.key_path(key)
+
+    def put(self, key: str, data: bytes):
+        destination = self.key_path(key, create=True)
+        partial = destination.with_name(destination.name + '.part')
+        partial.write_bytes(data)
+        os.replace(partial, destination)
+
+    def put_file(self, key: str, path: Path):
+        destination = self.key_path(key, create=True)
+        try:
+            os.replace(path, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # The file is on a different filesystem, so copy next to the destination first to keep the move atomic
+            partial = destination.with_name(destination.name + '.part')
+            shutil.copyfile(path, partial)
+            os.replace(partial, destination)
+            path.unlink()
+        os.utime(destination)  # yt-dlp dates files by their upload time, which would put them past the gc grace period
+
+    def get(self, key: str) -> bytes:
+        return self.key_path(key).read_bytes()
+
+    def get_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        with self.key_path(key).open("rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key: str):
+        self.key_path(key).unlink(missing_ok=True)
+
+    def stat(self, key: str) -> BlobStat | None:
+        try:
+            stat = self.key_path(key).stat()
+        except FileNotFoundError:
+            return None
+        return BlobStat(key, stat.st_size, stat.st_mtime)
+
+    def list(self) -> Iterator[BlobStat]:
+        for entry in self.scan():
+            if entry.name.endswith('.part') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Deleted since it was listed
+                continue
+            yield BlobStat(entry.name, stat.st_size, stat.st_mtime)
+
+    def touch(self, key: str):
+        os.utime(self.key_path(key))
+
+    def quarantine(self, key: str):
+        self.quarantine_dir.mkdir(parents=True, exist_ok=True)
+        destination = self.quarantine_dir.joinpath(key)
+        os.replace(self.key_path(key), destination)
+        os.utime(destination)
+
+    def quarantined(self) -> Iterator[BlobStat]:
+        if not self.quarantine_dir.exists():
+            return
+        with os.scandir(self.quarantine_dir) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                yield BlobStat(entry.name, stat.st_size, stat.st_mtime)
+
+    def purge(self, key: str):
+        self.quarantine_dir.joinpath(key).unlink(missing_ok=True)
+
+    def flat_blobs(self) -> Iterator[os.DirEntry]:
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    yield entry
+
+    def has_flat_blobs(self) -> bool:
+        return next(self.flat_blobs(), None) is not None
+
+    # Every blob file, flat ones first, without listing any one directory in full at once
+    def scan(self, directory: Path = None, depth: int = 0) -> Iterator[os.DirEntry]:
+        with os.scandir(directory or self.root) as entries:
+            for entry in entries:
+                if depth < self.levels and entry.is_dir():
+                    yield from self.scan(Path(entry.path), depth + 1)
+                elif depth == self.levels or entry.is_file():
+                    yield entry
+
+    # Moves flat blobs into their shards, returning how many were moved.
+    # Each move is a rename within the same filesystem, so readers see either the old path or the new one.
+    def migrate(self, entries: Iterable[os.DirEntry]) -> int:
+        moved = 0
+        for entry in entries:
+            try:
+                os.replace(entry.path, self.key_path(entry.name, create=True))
+                moved += 1
+            except FileNotFoundError:  # Deleted since it was listed
+                continue
+        return moved
+
+
+# Keeps blobs in an s3 compatible bucket (aws, minio, ...), under {prefix}data/,
+# with quarantined blobs under {prefix}quarantine/.
+# Takes a boto3 s3 client, or anything with the same methods.
+class S3Store(BlobStore):
+    def __init__(self, client, bucket: str, prefix: str = ''):
+        self.client = client
+        self.bucket = bucket
+        self.data_prefix = f"{prefix}data/"
+        self.quarantine_prefix = f"{prefix}quarantine/"
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.data_prefix + key, Body=data)
+
+    def put_file(self, key: str, path: Path):
+        self.client.upload_file(str(path), self.bucket, self.data_prefix + key)
+        path.unlink()
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=self.data_prefix + key)["Body"].read()
+
+    def get_range(self, key: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.data_prefix + key, Range=f"bytes={start}-{end}")
+        body = response["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.data_prefix + key)
+
+    def stat(self, key: str) -> BlobStat | None:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.data_prefix + key)
+        except Exception as e:
+            if not_found(e):
+                return None
+            raise
+        return BlobStat(key, head["ContentLength"], head["LastModified"].timestamp())
+
+    def list_prefix(self, prefix: str) -> Iterator[BlobStat]:
+        options = {"Bucket": self.bucket, "Prefix": prefix}
+        while True:
+            page = self.client.list_objects_v2(**options)
+            for item in page.get("Contents", []):
+                yield BlobStat(item["Key"][len(prefix):], item["Size"], item["LastModified"].timestamp())
+            if not page.get("IsTruncated"):
+                return
+            options["ContinuationToken"] = page["NextContinuationToken"]
+
+    def list(self) -> Iterator[BlobStat]:
+        return self.list_prefix(self.data_prefix)
+
+    def touch(self, key: str):
+        # Copying an object onto itself is the only way to update its modified time
+        name = self.data_prefix + key
+        self.client.copy_object(Bucket=self.bucket, Key=name, CopySource={"Bucket": self.bucket, "Key": name},
+                                MetadataDirective="REPLACE")
+
+    def quarantine(self, key: str):
+        self.client.copy_object(Bucket=self.bucket, Key=self.quarantine_prefix + key,
+                                CopySource={"Bucket": self.bucket, "Key": self.data_prefix + key})
+        self.delete(key)
+
+    def quarantined(self) -> Iterator[BlobStat]:
+        return self.list_prefix(self.quarantine_prefix)
+
+    def purge(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.quarantine_prefix + key)
+
+
+# botocore raises ClientError for a missing object, with the http status as the error code
+def not_found(e: Exception) -> bool:
+    code = getattr(e, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+# The store chosen by the blob_store env var, 'local' (default) or 's3'.
+# s3 needs boto3 (the s3 extra), and is configured with s3_bucket, s3_prefix and s3_endpoint_url
+# (for minio and the like), with credentials found by boto3 as usual.
+def make_blob_store(root: Path) -> BlobStore:
+    kind = environ.get('blob_store', 'local')
+    if kind == 'local':
+        return ShardedLayout(root)
+    if kind != 's3':
+        raise ValueError(f"Unknown blob store {kind}")
+
+    try:
+        import boto3
+    except ImportError:
+        raise RuntimeError("blob_store=s3 needs boto3, install the s3 extra") from None
+
+    client = boto3.client('s3', endpoint_url=environ.get('s3_endpoint_url'))
+    return S3Store(client, environ['s3_bucket'], environ.get('s3_prefix', ''))
+
+
+# Migrates flat blobs in batches off the event loop, so the server keeps serving while it runs
+async def migrate_online(layout: ShardedLayout, batch_size: int = 500, pause: float = 0.05) -> int:
+    moved = 0
+    while batch := await blob_io.run('migrate', lambda: list(islice(layout.flat_blobs(), batch_size))):
+        moved += await blob_io.run('migrate', layout.migrate, batch)
+        await asyncio.sleep(pause)
+
+    layout.migrating = False
+    print(f"Moved {moved} blobs into shards")
+    return moved
+
+
+# The same migration by hand, without waiting for the server to start it: python -m app.storage [db/data]
+if __name__ == "__main__":
+    root = Path(sys.argv[1] if len(sys.argv) > 1 else './db/data').resolve()
+    asyncio.run(migrate_online(ShardedLayout(root), pause=0))
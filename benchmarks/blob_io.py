@@ -0,0 +1,75 @@
+# Event loop lag while many blobs are streamed at once, reading on the loop compared to the blob io pool.
+# Run from the repo root: python -m benchmarks.blob_io [streams] [megabytes]
+# The page cache is dropped before each run if possible (needs root), as cold reads are what block.
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from app.blobio import Timings
+from app.responses import BlobResponse, CHUNK_SIZE
+
+STREAMS = 16
+MEGABYTES = 64
+
+
+def drop_page_cache():
+    try:
+        os.sync()
+        Path('/proc/sys/vm/drop_caches').write_text('3\n')
+    except OSError:
+        pass
+
+
+async def discard(message):
+    await asyncio.sleep(0)  # Like a socket that's always ready to write
+
+
+# The old way, reading each chunk with a plain blocking read on the loop
+async def stream_on_loop(path: Path, size: int):
+    with path.open("rb") as f:
+        for _ in range(0, size, CHUNK_SIZE):
+            await discard({"type": "http.response.body", "body": f.read(CHUNK_SIZE), "more_body": True})
+
+
+async def stream_on_pool(path: Path, size: int):
+    await BlobResponse(path, [(0, size - 1)])({"type": "http", "extensions": {}}, None, discard)
+
+
+async def sample_lag(lag: Timings, done: asyncio.Event, interval: float = 0.005):
+    while not done.is_set():
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        lag.record(max(perf_counter() - start - interval, 0))
+
+
+async def bench(stream, paths: list[Path], size: int) -> tuple[float, dict]:
+    lag = Timings()
+    done = asyncio.Event()
+    sampler = asyncio.create_task(sample_lag(lag, done))
+
+    start = perf_counter()
+    await asyncio.gather(*[stream(path, size) for path in paths])
+    elapsed = perf_counter() - start
+
+    done.set()
+    await sampler
+    return elapsed, lag.stats()
+
+
+if __name__ == "__main__":
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else STREAMS
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else MEGABYTES) * 1024 * 1024
+
+    with tempfile.TemporaryDirectory(dir=".") as workspace:  # Not /tmp, which may be in memory
+        paths = [Path(workspace, f"blob{i}") for i in range(streams)]
+        for path in paths:
+            path.write_bytes(os.urandom(size))
+
+        for name, stream in [("on loop", stream_on_loop), ("blob io pool", stream_on_pool)]:
+            drop_page_cache()
+            elapsed, lag = asyncio.run(bench(stream, paths, size))
+            print(f"{name:<13} {streams * size / elapsed / 1024 / 1024:8.1f} MB/s    loop lag p50 {lag['p50_ms']:6.2f} ms"
+                  f"  p99 {lag['p99_ms']:6.2f} ms  max {lag['max_ms']:6.2f} ms")
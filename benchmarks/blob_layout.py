@@ -0,0 +1,62 @@
+# Lookup and scan times of a flat data directory compared to sharded layouts.
+# Run from the repo root: python -m benchmarks.blob_layout [files]
+# The files are made empty in a temporary directory, which is removed afterwards.
+import os
+import random
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+from uuid import uuid4
+
+from app.storage import ShardedLayout
+
+FILES = 100_000
+LOOKUPS = 10_000
+LAYOUTS = [(1, 2), (2, 2)]  # (levels, width), the first is the default
+
+
+def lookups(paths: list[Path]) -> float:
+    start = perf_counter()
+    for path in paths:
+        path.stat()
+    return (perf_counter() - start) / len(paths)
+
+
+def scan(entries) -> tuple[float, int]:
+    start = perf_counter()
+    count = sum(1 for _ in entries)
+    return perf_counter() - start, count
+
+
+def report(name: str, lookup: float, scan_time: float, count: int):
+    print(f"{name:<16} lookup {lookup * 1e6:8.2f} us    scan {scan_time * 1000:9.2f} ms for {count} entries")
+
+
+if __name__ == "__main__":
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else FILES
+    uuids = [str(uuid4()) for _ in range(files)]
+    sample = random.sample(uuids, min(LOOKUPS, files))
+
+    workspace = Path(tempfile.mkdtemp())
+    try:
+        print(f"{files} files")
+
+        flat_root = workspace.joinpath('flat')
+        flat_root.mkdir()
+        for uuid in uuids:
+            flat_root.joinpath(f"{uuid}.webm").touch()
+        report("flat", lookups([flat_root.joinpath(f"{uuid}.webm") for uuid in sample]), *scan(os.scandir(flat_root)))
+
+        for levels, width in LAYOUTS:
+            root = workspace.joinpath(f"sharded-{levels}-{width}")
+            root.mkdir()
+            layout = ShardedLayout(root, levels, width)
+            for uuid in uuids:
+                layout.path(uuid, 'webm', create=True).touch()
+            # Lookups include working out the shard
+            report(f"sharded {levels}x{width}", lookups([layout.path(uuid, 'webm') for uuid in sample]),
+                   *scan(layout.scan()))
+    finally:
+        shutil.rmtree(workspace)
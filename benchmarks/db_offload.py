@@ -0,0 +1,69 @@
+# Latency of /ping while a big /fullsync is running, with db work on the event loop compared to on the db threads.
+# Run from the repo root: python -m benchmarks.db_offload [playlists] [songs per playlist]
+# Uses the test database (db/test.db), which it wipes.
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from time import perf_counter
+
+environ['testdb'] = '1'
+
+from httpx import AsyncClient
+
+import app.db as db
+from app.blobio import Timings
+from app.main import app
+from app.models import Base
+
+PLAYLISTS = 20
+SONGS = 500
+PING_INTERVAL = 0.005
+
+
+def payload(playlists: int, songs: int) -> dict:
+    return {"playlists": [{
+        "title": f"playlist {p}",
+        "songs": [{
+            "title": f"song {s}",
+            "album": f"album {s % 50}",
+            "artist": f"artist {s % 30}",
+            "duration": 180.0,
+            "extractor": "youtube",
+            "weburl": f"https://example.com/{(p * songs // 2 + s)}",  # Playlists share half their songs
+        } for s in range(songs)]
+    } for p in range(playlists)]}
+
+
+async def bench(data: dict) -> tuple[float, dict]:
+    latencies = Timings()
+    async with AsyncClient(app=app, base_url="http://bench", timeout=None) as client:
+        (await client.post('/fullsync', json=data)).raise_for_status()  # So the measured sync replaces a library
+
+        start = perf_counter()
+        sync = asyncio.create_task(client.post('/fullsync', json=data))
+        # Latency counts from when each ping was due, so time the loop spent blocked before sending it is included
+        due = perf_counter()
+        while not sync.done():
+            await asyncio.sleep(max(due - perf_counter(), 0))
+            (await client.get('/ping')).raise_for_status()
+            latencies.record(perf_counter() - due)
+            due += PING_INTERVAL
+        (await sync).raise_for_status()
+
+    return perf_counter() - start, latencies.stats()
+
+
+if __name__ == "__main__":
+    playlists = int(sys.argv[1]) if len(sys.argv) > 1 else PLAYLISTS
+    songs = int(sys.argv[2]) if len(sys.argv) > 2 else SONGS
+    data = payload(playlists, songs)
+
+    for mode in ['loop', 'thread']:
+        db.db_executor = None if mode == 'loop' else ThreadPoolExecutor(db.db_workers, thread_name_prefix="db")
+        Base.metadata.drop_all(db.engine)
+        Base.metadata.create_all(db.engine)
+
+        elapsed, ping = asyncio.run(bench(data))
+        print(f"db_mode={mode:<7} fullsync {elapsed:6.2f} s    /ping p50 {ping['p50_ms']:8.2f} ms"
+              f"  p99 {ping['p99_ms']:8.2f} ms  max {ping['max_ms']:8.2f} ms  ({ping['count']} pings)")
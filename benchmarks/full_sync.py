@@ -0,0 +1,68 @@
+# Time and database pages written by /fullsync of a library that's unchanged, and of one with a few changes.
+# Run from the repo root: python -m benchmarks.full_sync [songs] [playlists]
+# Uses a database in a temporary directory.
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy.orm import sessionmaker
+
+import app.crud as crud
+import app.models as models
+import app.schemas as schemas
+from app.db import make_engine, sqlite_pragmas
+
+SONGS = 15000
+PLAYLISTS = 20
+CHANGED = 0.01  # Share of songs retitled, and added to the first playlist, in the changed sync
+
+
+def payload(songs: int, playlists: int, changed: float = 0) -> schemas.FullSync:
+    retitled = int(songs * changed)
+    return schemas.FullSync(playlists=[{
+        "title": f"playlist {p}",
+        "songs": [{
+            "title": f"song {s}" + (" (remastered)" if s < retitled else ""),
+            "album": f"album {s % 500}",
+            "artist": f"artist {s % 300}",
+            "duration": 180.0,
+            "extractor": "youtube",
+            "weburl": f"https://example.com/{s}",
+        } for s in range(p, songs, playlists // 4 or 1)]  # Each song is in about 4 playlists
+        + ([{"title": f"new song {s}", "weburl": f"https://example.com/new/{s}"} for s in range(retitled)]
+           if p == 0 else [])
+    } for p in range(playlists)])
+
+
+# Bytes the sync wrote to the WAL, which are all checkpointed into the database file afterwards
+def sync(Session, data: schemas.FullSync, wal: Path) -> tuple[float, int]:
+    db = Session()
+    db.connection().exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.commit()
+
+    start = perf_counter()
+    crud.fullSync(data, db)
+    elapsed = perf_counter() - start
+
+    written = wal.stat().st_size
+    db.close()
+    return elapsed, written
+
+
+if __name__ == "__main__":
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else SONGS
+    playlists = int(sys.argv[2]) if len(sys.argv) > 2 else PLAYLISTS
+
+    with tempfile.TemporaryDirectory(dir=".") as workspace:
+        # Without automatic checkpoints, so everything written stays in the WAL to be counted
+        engine = make_engine(f"sqlite:///{Path(workspace, 'library.db')}",
+                             pragmas={**sqlite_pragmas, 'wal_autocheckpoint': 0})
+        models.Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+
+        for name, data in [("first", payload(songs, playlists)),
+                           ("unchanged", payload(songs, playlists)),
+                           ("changed", payload(songs, playlists, CHANGED))]:
+            elapsed, written = sync(Session, data, Path(workspace, 'library.db-wal'))
+            print(f"{name:<10} {elapsed * 1000:9.1f} ms  {written / 1024 / 1024:8.2f} MB written")
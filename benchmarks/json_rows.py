@@ -0,0 +1,74 @@
+# Build + encode time of full library responses through the schemas (as fastapi used to encode them) compared to
+# rows built from column queries, encoded with orjson and with the standard library.
+# Run from the repo root: python -m benchmarks.json_rows [songs] [playlists]
+# Uses a database in a temporary directory.
+import gc
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import sessionmaker
+
+import app.crud as crud
+import app.fastjson as fastjson
+import app.schemas as schemas
+from app.db import make_engine
+from benchmarks.playlist_format import seed, SONGS, PLAYLISTS
+
+RUNS = 3
+
+
+def pydantic_songs(db) -> bytes:
+    return JSONResponse(jsonable_encoder([schemas.Song.from_orm(song) for song in crud.getSongs(db)])).body
+
+
+def pydantic_playlists(db) -> bytes:
+    playlists = [schemas.Playlist.from_orm(playlist) for playlist in crud.getPlaylists(db, shallow=False)]
+    return JSONResponse(jsonable_encoder(playlists)).body
+
+
+def bench(Session, build) -> float:
+    best = None
+    for _ in range(RUNS):
+        db = Session()
+        start = perf_counter()
+        build(db)
+        elapsed = perf_counter() - start
+        db.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else SONGS
+    playlists = int(sys.argv[2]) if len(sys.argv) > 2 else PLAYLISTS
+    orjson = fastjson.orjson
+
+    # The cyclic gc collecting the ORM objects of a big eager loaded library has been seen to segfault
+    # (SQLAlchemy 1.4.54, python 3.11.7), so it's off while measuring. That only flatters the pydantic path.
+    gc.disable()
+
+    with tempfile.TemporaryDirectory(dir=".") as workspace:
+        engine = make_engine(f"sqlite:///{Path(workspace, 'library.db')}")
+        seed(engine, songs, playlists)
+        Session = sessionmaker(bind=engine)
+
+        for path, pydantic, rows in [
+            ("/song", pydantic_songs, lambda db: fastjson.dumps(crud.getSongRows(db))),
+            ("/playlist?shallow=false", pydantic_playlists,
+             lambda db: fastjson.dumps(crud.getPlaylistRows(db, shallow=False))),
+        ]:
+            timings = {"pydantic": bench(Session, pydantic)}
+            for name, encoder in [("rows + orjson", orjson), ("rows + json", None)]:
+                if name == "rows + orjson" and orjson is None:
+                    continue
+                fastjson.orjson = encoder
+                timings[name] = bench(Session, rows)
+            fastjson.orjson = orjson
+
+            print(path)
+            for name, elapsed in timings.items():
+                print(f"    {name:<14} {elapsed * 1000:9.1f} ms")
@@ -0,0 +1,76 @@
+# Size and build + encode time of the whole library as nested playlists (/playlist?shallow=false) compared to
+# the normalized format (/playlist?normalized=true).
+# Run from the repo root: python -m benchmarks.playlist_format [songs] [playlists]
+# Uses a database in a temporary directory.
+import random
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import sessionmaker
+
+import app.crud as crud
+import app.models as models
+import app.schemas as schemas
+from app.db import make_engine
+
+SONGS = 10000
+PLAYLISTS = 20
+MEMBERSHIPS = 3  # Average playlists each song is in
+RUNS = 3
+
+
+def seed(engine, songs: int, playlists: int):
+    models.Base.metadata.create_all(engine)
+    rng = random.Random(0)
+    with engine.begin() as connection:
+        connection.execute(models.Artist.__table__.insert(), [{"title": f"artist {i}"} for i in range(songs // 20)])
+        connection.execute(models.Album.__table__.insert(), [{"title": f"album {i}"} for i in range(songs // 10)])
+        connection.execute(models.Song.__table__.insert(), [{
+            "title": f"song {i}", "weburl": f"https://example.com/{i}", "disabled": False, "duration": 180.0,
+            "extractor": "youtube", "artist_id": rng.randint(1, songs // 20), "album_id": rng.randint(1, songs // 10),
+        } for i in range(songs)])
+        connection.execute(models.Playlist.__table__.insert(), [{"title": f"playlist {i}"} for i in range(playlists)])
+        connection.execute(models.PlaylistSong.__table__.insert(), [
+            {"playlist_id": playlist, "song_id": song, "dateadded": datetime(2022, 1, 1)}
+            for song in range(1, songs + 1)
+            for playlist in rng.sample(range(1, playlists + 1), rng.randint(1, MEMBERSHIPS * 2 - 1))
+        ])
+
+
+def nested(db) -> list[schemas.Playlist]:
+    return [schemas.Playlist.from_orm(playlist) for playlist in crud.getPlaylists(db, shallow=False)]
+
+
+def normalized(db) -> schemas.Library:
+    return crud.getLibrary(db)
+
+
+def bench(Session, build) -> tuple[float, int]:
+    best = None
+    for _ in range(RUNS):
+        db = Session()
+        start = perf_counter()
+        body = JSONResponse(jsonable_encoder(build(db))).body  # As main.cachedLibraryResponse encodes it
+        elapsed = perf_counter() - start
+        db.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+if __name__ == "__main__":
+    songs = int(sys.argv[1]) if len(sys.argv) > 1 else SONGS
+    playlists = int(sys.argv[2]) if len(sys.argv) > 2 else PLAYLISTS
+
+    with tempfile.TemporaryDirectory(dir=".") as workspace:
+        engine = make_engine(f"sqlite:///{Path(workspace, 'library.db')}")
+        seed(engine, songs, playlists)
+        Session = sessionmaker(bind=engine)
+
+        for name, build in [("nested", nested), ("normalized", normalized)]:
+            elapsed, size = bench(Session, build)
+            print(f"{name:<11} {size / 1024 / 1024:8.2f} MB  build + encode {elapsed * 1000:8.1f} ms")
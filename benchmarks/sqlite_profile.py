@@ -0,0 +1,101 @@
+# Read latency while something keeps writing, with sqlite's defaults and one engine (as before) compared to
+# the WAL profile with separate read and write engines.
+# Run from the repo root: python -m benchmarks.sqlite_profile [readers] [seconds]
+# Uses a database in a temporary directory.
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter, sleep
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import app.models as models
+from app.blobio import Timings
+from app.db import make_engine
+
+READERS = 4
+SECONDS = 5
+SONGS = 50000
+
+
+def seed(engine):
+    models.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    db.execute(models.Song.__table__.insert(), [
+        {"title": f"song {i}", "weburl": f"https://example.com/{i}", "disabled": False} for i in range(SONGS)])
+    db.commit()
+    db.close()
+
+
+def reader(Session, stop: threading.Event, latencies: Timings, errors: list):
+    n = 0
+    while not stop.is_set():
+        db = Session()
+        start = perf_counter()
+        try:
+            db.get(models.Song, n % SONGS + 1)
+            latencies.record(perf_counter() - start)
+            n += 7919
+        except OperationalError as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+
+# Rewrites every song in one transaction, like a full sync does. That's more than sqlite's default page cache
+# holds, so without WAL it has to lock out readers before it can spill changes into the file.
+def writer(Session, stop: threading.Event, commits: list):
+    n = 0
+    while not stop.is_set():
+        db = Session()
+        try:
+            db.execute(models.Song.__table__.update().values(title=models.Song.title + "!"))
+            db.commit()
+            commits.append(n)
+            n += 1
+        except OperationalError:
+            db.rollback()
+        finally:
+            db.close()
+
+
+def bench(write_engine, read_engine, readers: int, seconds: float) -> tuple[dict, int, int]:
+    stop = threading.Event()
+    latencies = Timings()
+    errors = []
+    commits = []
+    ReadSession = sessionmaker(bind=read_engine)
+    threads = [threading.Thread(target=reader, args=(ReadSession, stop, latencies, errors)) for _ in range(readers)]
+    threads.append(threading.Thread(target=writer, args=(sessionmaker(bind=write_engine), stop, commits)))
+
+    for thread in threads:
+        thread.start()
+    sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return latencies.stats(), len(errors), len(commits)
+
+
+if __name__ == "__main__":
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else READERS
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else SECONDS
+
+    with tempfile.TemporaryDirectory(dir=".") as workspace:
+        for name in ["default", "profile"]:
+            url = f"sqlite:///{Path(workspace, name + '.db')}"
+            if name == "default":
+                write_engine = read_engine = create_engine(url, connect_args={"check_same_thread": False})
+            else:
+                write_engine = make_engine(url)
+                read_engine = make_engine(url, readonly=True, pool_size=readers)
+            seed(write_engine)
+
+            reads, errors, commits = bench(write_engine, read_engine, readers, seconds)
+            print(f"{name:<8} reads {reads['count'] / seconds:8.1f}/s  p50 {reads['p50_ms']:7.2f} ms"
+                  f"  p99 {reads['p99_ms']:8.2f} ms  max {reads['max_ms']:8.2f} ms  read errors {errors}"
+                  f"  write commits {commits}")
@@ -0,0 +1,45 @@
+# Per-download setup cost of a fresh YoutubeDL instance, compared to reusing one from the pool.
+# Run from the repo root: python -m benchmarks.ytdl_instances [url]
+# Without a url only the setup is timed, with one the metadata of that url is also extracted each time.
+import sys
+from time import perf_counter
+
+from yt_dlp import YoutubeDL as Extractinator
+
+from app.extractor import download_options, get_ytdl, locallogger
+
+RUNS = 50
+
+
+def fresh(url: str | None):
+    with Extractinator({**download_options, "logger": locallogger}) as downloader:
+        downloader.params['outtmpl']['default'] = './extractions/benchmark'
+        if url:
+            downloader.extract_info(url, download=False)
+
+
+def pooled(url: str | None):
+    downloader = get_ytdl(download_options)
+    downloader.params['outtmpl']['default'] = './extractions/benchmark'
+    if url:
+        downloader.extract_info(url, download=False)
+
+
+def bench(func, url: str | None, runs: int) -> float:
+    start = perf_counter()
+    for _ in range(runs):
+        func(url)
+    return (perf_counter() - start) / runs
+
+
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    runs = RUNS if url is None else 5
+
+    pooled(url)  # So the pool's one-off setup isn't counted
+    fresh_time = bench(fresh, url, runs)
+    pooled_time = bench(pooled, url, runs)
+
+    print(f"fresh instance:  {fresh_time * 1000:8.2f} ms per download")
+    print(f"pooled instance: {pooled_time * 1000:8.2f} ms per download")
+    print(f"saved:           {(fresh_time - pooled_time) * 1000:8.2f} ms per download")
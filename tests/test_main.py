@@ -1,4 +1,38 @@
-from testconf import client, make_test_db
+import asyncio
+import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import md5
+from pathlib import Path
+from urllib.error import HTTPError
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from yt_dlp.utils import DownloadError
+
+import app.blobgc as blobgc
+import app.changelog as changelog
+import app.crud as crud
+import app.extractor as extractor
+import app.fastjson as fastjson
+import app.main as main
+import app.scheduler as scheduler
+from app.blobcache import BlobCache
+from app.blobio import BlobIO, blob_io
+from app.db import make_engine
+from app.extractor import get_data_path, RecyclingProcessPool, get_ytdl, download_options, ingest_file, \
+    extractDir, extract
+from app.models import Song, Album, Artist, Playlist, PlaylistSong
+from app.responsecache import ResponseCache
+from app.responses import file_response
+from app.scheduler import DownloadScheduler
+from app.schemas import Thumbnail
+from app.singleflight import SingleFlight
+from app.storage import ShardedLayout, S3Store, migrate_online
+from testconf import client, make_test_db, TestingSessionLocal, FakeS3Client, engine
 
 
 def test_pong():
@@ -26,6 +60,13 @@ def test_get_playlists():
     assert response.status_code == 422
 
 
+def test_get_playlists_normalized():
+    make_test_db()
+    response = client.get('/playlist', params={'normalized': 'true'})
+    assert (response.status_code == 200)
+    expected = """{"songs":[{"id":1,"title":"song1","weburl":"https://www.youtube.com/watch?v=iSqnJPdyqFM","disabled":true,"album_id":1,"duration":50.3,"extractor":"youtube","artist_id":1},{"id":2,"title":"song4","weburl":"a bad url","disabled":false,"album_id":1,"duration":null,"extractor":null,"artist_id":1},{"id":3,"title":"song2","weburl":"https://www.youtube.com/watch?v=ggHN5ZJ8jkU","disabled":false,"album_id":2,"duration":22.3,"extractor":"bandcamp","artist_id":2},{"id":4,"title":"song3","weburl":"https://www.youtube.com/watch?v=BbbcvFJ55F4","disabled":false,"album_id":2,"duration":10.3,"extractor":"youtube","artist_id":2}],"artists":[{"id":1,"title":"artist2"},{"id":2,"title":"artist1"}],"albums":[{"id":1,"title":"album2"},{"id":2,"title":"album1"}],"playlists":[{"id":1,"title":"playlist1","songs":[[1,"2022-04-23T02:40:00"],[3,"2022-04-24T02:40:00"],[2,"2022-04-26T02:40:00"]]},{"id":2,"title":"playlist2","songs":[[4,"2022-04-26T02:40:00"],[3,"2022-04-25T02:40:00"]]}]}"""
+    assert (response.text == expected)
+
 def test_get_playlist():
     make_test_db()
     response = client.get('/playlist/1')
@@ -142,10 +183,41 @@ def test_get_song():
 
 
 def test_get_song_src():
-    # todo: fix this test with data in files instead of db
     make_test_db()
     response = client.get('/song/3/src')
+    assert (response.status_code == 200)
+    assert (response.content == b'some 2 sound bytes')
+    assert (response.headers['content-length'] == '18')
+    assert (response.headers['accept-ranges'] == 'bytes')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=5-'})
+    assert (response.status_code == 206)
+    assert (response.content == b'2 sound bytes')
+    assert (response.headers['content-range'] == 'bytes 5-17/18')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=0-3'})
+    assert (response.status_code == 206)
+    assert (response.content == b'some')
+    assert (response.headers['content-range'] == 'bytes 0-3/18')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=-5'})
     assert (response.status_code == 206)
+    assert (response.content == b'bytes')
+    assert (response.headers['content-range'] == 'bytes 13-17/18')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=0-3,13-'})
+    assert (response.status_code == 206)
+    assert (response.headers['content-type'].startswith('multipart/byteranges; boundary='))
+    assert (int(response.headers['content-length']) == len(response.content))
+    assert (b'Content-Range: bytes 0-3/18\r\n\r\nsome\r\n' in response.content)
+    assert (b'Content-Range: bytes 13-17/18\r\n\r\nbytes\r\n' in response.content)
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=100-'})
+    assert (response.status_code == 416)
+    assert (response.headers['content-range'] == 'bytes */18')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=nonsense'})
+    assert (response.status_code == 200)
     assert (response.content == b'some 2 sound bytes')
 
     response = client.get('/song/1/src')
@@ -155,6 +227,756 @@ def test_get_song_src():
     assert (response.status_code == 469)
 
 
+def test_get_song_src_without_copying():
+    make_test_db()
+    response = file_response(get_data_path("another uuid", "mp4"), "audio/mp4", "bytes=0-3,13-")
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'extensions': {'http.response.zerocopy': {}}}
+    asyncio.run(response(scope, None, send))
+
+    zerocopy = [message for message in messages if message['type'] == 'http.response.zerocopy']
+    assert ([(message['offset'], message['count']) for message in zerocopy] == [(0, 4), (13, 5)])
+    assert (messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    messages.clear()
+    asyncio.run(response({'type': 'http'}, None, send))
+    body = b''.join(bytes(message.get('body', b'')) for message in messages[1:])
+    assert (b'Content-Range: bytes 0-3/18\r\n\r\nsome\r\n' in body)
+    assert (b'Content-Range: bytes 13-17/18\r\n\r\nbytes\r\n' in body)
+    assert (len(body) == int(response.headers['content-length']))
+
+
+def test_empty_blob_response(tmp_path):
+    empty = tmp_path.joinpath('empty.mp4')
+    empty.write_bytes(b'')
+    response = file_response(empty, "audio/mp4", None)
+    assert (response.headers['content-length'] == '0')
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response({'type': 'http'}, None, send))  # Mapped when there's no zerocopy, which empty files can't be
+    assert (messages[0]['status'] == 200)
+    assert (b''.join(bytes(message.get('body', b'')) for message in messages[1:]) == b'')
+    assert (messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def test_deleted_blob_response(tmp_path):
+    deleted = tmp_path.joinpath('deleted.mp4')
+    deleted.write_bytes(b'some sound bytes')
+    response = file_response(deleted, "audio/mp4", None)
+    deleted.unlink()  # By the blob gc, between making the response and sending it
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response({'type': 'http'}, None, send))
+    assert (messages[0]['type'] == 'http.response.start' and messages[0]['status'] == 404)
+    assert ([message['type'] for message in messages].count('http.response.start') == 1)
+
+
+def test_missing_blob():
+    make_test_db()
+    db = TestingSessionLocal()
+    song = db.get(Song, 4)
+    song.data_uuid, song.dataext = 'missing uuid', 'mp4'
+    db.commit()
+
+    for size in [None, 10, 1024 * 1024 * 1024]:  # Unknown, small enough to cache, and streamed
+        song.datasize = size
+        db.commit()
+        response = client.get('/song/4/src')
+        assert (response.status_code == 404)
+        assert (response.json() == {'detail': 'Blob not found'})
+
+    song.datasize = None
+    db.commit()
+    assert (client.head('/song/4/src').status_code == 404)
+    db.close()
+
+
+def test_get_thumb():
+    make_test_db()
+    response = client.get('/thumb/1')
+    assert (response.status_code == 200)
+    assert (response.content == b'some image bytes')
+    assert (response.headers['content-type'] == 'image/png')
+    assert (response.headers['content-length'] == '16')
+
+    response = client.get('/thumb/1', headers={'Range': 'bytes=0-3'})
+    assert (response.status_code == 200)
+    assert (response.content == b'some image bytes')
+
+    response = client.get('/thumb/100')
+    assert (response.status_code == 404)
+
+
+def test_blob_cache():
+    cache = BlobCache(10, 6)
+    cache.put('a', b'12345')
+    cache.put('b', b'1234')
+    assert (cache.get('a') == b'12345')
+    cache.put('c', b'123')  # Evicts b, as a was used more recently
+    cache.put('d', b'1234567')  # Too big to cache
+    assert (cache.get('b') is None)
+    assert (cache.get('d') is None)
+    assert (cache.get('c') == b'123')
+    assert (cache.stats() == {'entries': 2, 'size': 8, 'budget': 10, 'hits': 2, 'misses': 2, 'evictions': 1})
+
+    make_test_db()
+    hits = client.get('/stats').json()['blob_cache']['thumbnail']['hits']
+    client.get('/thumb/1')
+    response = client.get('/thumb/1')
+    assert (response.content == b'some image bytes')
+    assert (client.get('/stats').json()['blob_cache']['thumbnail']['hits'] > hits)
+
+
+def test_conditional_get():
+    make_test_db()
+    response = client.get('/playlist', params={'shallow': False})
+    etag = response.headers['etag']
+    assert (response.status_code == 200)
+
+    response = client.get('/playlist', params={'shallow': False}, headers={'If-None-Match': etag})
+    assert (response.status_code == 304)
+    assert (response.content == b'')
+
+    # Only the etag is a validator, dates have one second resolution, and the library can change within a second
+    assert ('last-modified' not in response.headers)
+    response = client.get('/song/1', headers={'If-Modified-Since': 'Sun, 06 Nov 2994 08:49:37 GMT'})
+    assert (response.status_code == 200)
+
+    client.put('/playlist/1', json={'title': 'updated title'})
+    response = client.get('/playlist', params={'shallow': False}, headers={'If-None-Match': etag})
+    assert (response.status_code == 200)
+    assert (response.headers['etag'] != etag)
+
+    response = client.get('/song/3/src', headers={'If-None-Match': '"another uuid"'})
+    assert (response.status_code == 304)
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=5-', 'If-Range': '"another uuid"'})
+    assert (response.status_code == 206)
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=5-', 'If-Range': '"an old uuid"'})
+    assert (response.status_code == 200)
+    assert (response.content == b'some 2 sound bytes')
+
+    response = client.get('/thumb/1', headers={'If-None-Match': '"a hash"'})
+    assert (response.status_code == 304)
+
+
+def test_backfill_blob_metadata():
+    make_test_db()
+    db = TestingSessionLocal()
+
+    async def backfill():
+        await asyncio.gather(*crud.blobMetadataBackfills(db), return_exceptions=True)
+
+    asyncio.run(backfill())
+    db.commit()
+
+    song = db.get(Song, 3)
+    assert ((song.datasize, song.datamime) == (18, 'audio/mp4'))
+    assert (song.datahash == md5(b'some 2 sound bytes').hexdigest())
+    assert ((song.thumbnail.size, song.thumbnail.mime) == (16, 'image/png'))
+    assert (db.get(Song, 2).datasize is None)  # Never downloaded
+    db.close()
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=5-'})
+    assert (response.content == b'2 sound bytes')
+    assert (response.headers['content-range'] == 'bytes 5-17/18')
+
+
+def test_head_song_src():
+    make_test_db()
+    response = client.head('/song/3/src')
+    assert (response.status_code == 200)
+    assert (response.content == b'')
+    assert (response.headers['content-length'] == '18')
+    assert (response.headers['content-type'] == 'audio/mp4')
+    assert (response.headers['etag'] == '"another uuid"')
+
+    response = client.head('/song/2/src')  # Must not try to download it
+    assert (response.status_code == 204)
+
+    response = client.head('/song/1/src')
+    assert (response.status_code == 410)
+
+    response = client.head('/song/100/src')
+    assert (response.status_code == 404)
+
+
+def test_probe_song_sources():
+    make_test_db()
+    response = client.post('/song/probe', json=[1, 2, 3, 100])
+    assert (response.status_code == 200)
+    assert (response.json() == [
+        {'id': 1, 'available': False, 'disabled': True, 'size': None, 'mime': 'audio/mp4'},
+        {'id': 2, 'available': False, 'disabled': False, 'size': None, 'mime': None},
+        {'id': 3, 'available': True, 'disabled': False, 'size': None, 'mime': 'audio/mp4'},
+    ])
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    async def download(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return url
+
+    async def run():
+        return await asyncio.gather(
+            flight.do('a', lambda: download('a')),
+            flight.do('a', lambda: download('a')),
+            flight.do('b', lambda: download('b')),
+        )
+
+    assert (asyncio.run(run()) == ['a', 'a', 'b'])
+    assert (calls == ['a', 'b'])
+    assert (flight.stats() == {'in_flight': 0, 'started': 2, 'coalesced': 1})
+
+
+def test_download_scheduler():
+    download_scheduler = DownloadScheduler(1)
+    order = []
+
+    async def download(name, priority, group=None):
+        async with download_scheduler.slot(priority, group, name):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        first = asyncio.create_task(download('first', scheduler.BULK))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(download(name, scheduler.BULK, group)) for name, group in
+                 [('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('b1', 'b')]]
+        tasks.append(asyncio.create_task(download('thumb', scheduler.THUMBNAIL)))
+        tasks.append(asyncio.create_task(download('play', scheduler.INTERACTIVE)))
+        await asyncio.sleep(0)
+        assert (download_scheduler.queued('a') == 3)
+        download_scheduler.promote('a3', scheduler.INTERACTIVE)
+        await asyncio.gather(first, *tasks)
+
+    asyncio.run(run())
+    assert (order == ['first', 'play', 'a3', 'thumb', 'a1', 'b1', 'a2'])
+    assert (download_scheduler.stats()['running'] == 0)
+
+
+def test_recycling_process_pool():
+    pool = RecyclingProcessPool(1, 2)
+    pids = [pool.submit(os.getpid).result() for _ in range(4)]
+    pool.shutdown()
+    assert (pids[0] == pids[1] and pids[2] == pids[3])
+    assert (pids[1] != pids[2])  # Replaced after 2 tasks
+    assert (os.getpid() not in pids)
+
+
+def test_ytdl_instances_are_reused():
+    downloader = get_ytdl(download_options)
+    assert (get_ytdl(dict(reversed(download_options.items()))) is downloader)
+    assert (get_ytdl({**download_options, 'format': 'bestaudio'}) is not downloader)
+
+    thread = ThreadPoolExecutor(1)
+    assert (thread.submit(get_ytdl, download_options).result() is not downloader)  # One per worker thread
+    thread.shutdown()
+
+
+def test_extract_outtmpl(monkeypatch):
+    downloader = get_ytdl(download_options)
+    monkeypatch.setattr(downloader, 'extract_info',
+                        lambda url: {'filepath': downloader.prepare_filename({'id': url, 'ext': 'webm'})})
+
+    for uuid in ['a uuid', 'another uuid']:  # The reused downloader writes where the latest download asked
+        info = extract(download_options, 'an id', f'./extractions/{uuid}.%(ext)s')
+        assert (Path(info['filepath']) == Path(f'./extractions/{uuid}.webm'))
+
+
+def test_refresh_thumbnail_only(monkeypatch):
+    make_test_db()
+    downloaded = []
+
+    async def downloadThumbnail(url):
+        downloaded.append(url)
+        return Thumbnail(hash='a hash', data=b'some image bytes', ext='png')
+
+    async def downloadSong(url):
+        raise AssertionError("Audio shouldn't be downloaded")
+
+    monkeypatch.setattr(crud, 'downloadThumbnail', downloadThumbnail)
+    monkeypatch.setattr(crud, 'downloadSong', downloadSong)
+
+    db = TestingSessionLocal()
+    song = db.get(Song, 2)
+    assert (asyncio.run(crud.getSongThumb(song, db)) is song)
+    assert (song.thumbnail.id == 1)  # Same hash as the existing thumbnail, so it is shared
+    assert (song.data_uuid is None)
+    assert (downloaded == ['a bad url'])
+    db.close()
+
+
+def test_dead_thumbnail_url(monkeypatch):
+    class Downloader:
+        def extract_info(self, url, download=True):
+            return {'thumbnail': 'https://example.com/gone.png'}
+
+        def urlopen(self, url):
+            raise HTTPError(url, 404, 'Not Found', None, None)
+
+    monkeypatch.setattr(extractor, 'get_ytdl', lambda options: Downloader())
+    try:
+        extractor.extractThumbnail(extractor.thumbnail_options, 'a url')
+        assert False
+    except DownloadError as e:
+        assert (pickle.loads(pickle.dumps(e)).msg == e.msg)  # So it can be sent back from a worker process
+
+    make_test_db()
+    response = client.get('/song/2/thumb')  # Song 2 has no thumbnail
+    assert (response.status_code == 469)
+
+
+def test_ingest_file():
+    extracted = extractDir.joinpath('an extraction')
+    extracted.write_bytes(b'some extracted bytes')
+
+    uuid, size, checksum = ingest_file(extracted, 'webm')
+    assert (not extracted.exists())
+    assert (get_data_path(uuid, 'webm').read_bytes() == b'some extracted bytes')
+    assert ((size, checksum) == (20, md5(b'some extracted bytes').hexdigest()))
+    get_data_path(uuid, 'webm').unlink()
+
+    # Content addressed blobs are shared between identical files
+    for _ in range(2):
+        extracted.write_bytes(b'some extracted bytes')
+        uuid, size, checksum = ingest_file(extracted, 'webm', True)
+        assert (uuid == checksum)
+        assert (not extracted.exists())
+    assert (get_data_path(uuid, 'webm').read_bytes() == b'some extracted bytes')
+
+
+def test_ingested_blobs_are_new():
+    make_test_db()
+    extracted = extractDir.joinpath('an old extraction')
+    extracted.write_bytes(b'uploaded years ago')
+    os.utime(extracted, (0, 0))  # As yt-dlp leaves it, dated by the upload
+    uuid, size, checksum = ingest_file(extracted, 'webm')
+
+    db = TestingSessionLocal()
+    asyncio.run(blobgc.collectGarbage(db, grace=60, quarantine=False, pause=0))
+    db.close()
+    assert (get_data_path(uuid, 'webm').exists())  # Not committed yet, but inside the grace period
+    get_data_path(uuid, 'webm').unlink()
+
+
+def test_release_audio():
+    make_test_db()
+    db = TestingSessionLocal()
+    assert (crud.audioRefCounts(db, {'another uuid', 'unused uuid'}) == {'another uuid': 3})
+
+    asyncio.run(crud.releaseAudio(db, {('another uuid', 'mp4')}))
+    assert (get_data_path('another uuid', 'mp4').exists())  # Other songs still use it
+
+    db.query(Song).filter(Song.data_uuid == 'another uuid').update({'data_uuid': None})
+    db.commit()
+    os.utime(get_data_path('another uuid', 'mp4'), (0, 0))
+    asyncio.run(crud.releaseAudio(db, {('another uuid', 'mp4')}))
+    assert (not get_data_path('another uuid', 'mp4').exists())
+
+    # A download reusing an unreferenced blob keeps it, as its song may not be committed yet
+    extracted = extractDir.joinpath('a reused extraction')
+    extracted.write_bytes(b'reused bytes')
+    uuid, size, checksum = ingest_file(extracted, 'mp4', True)
+    os.utime(get_data_path(uuid, 'mp4'), (0, 0))
+    extracted.write_bytes(b'reused bytes')
+    assert (ingest_file(extracted, 'mp4', True)[0] == uuid)
+    asyncio.run(crud.releaseAudio(db, {(uuid, 'mp4')}))
+    assert (get_data_path(uuid, 'mp4').exists())
+    get_data_path(uuid, 'mp4').unlink()
+    db.close()
+
+
+def test_blob_gc():
+    make_test_db()
+    db = TestingSessionLocal()
+    old = get_data_path('orphan', 'mp4', create=True)
+    old.write_bytes(b'orphaned bytes')
+    os.utime(old, (0, 0))
+    fresh = get_data_path('fresh orphan', 'mp4', create=True)
+    fresh.write_bytes(b'not committed yet')
+    os.utime(get_data_path('another uuid', 'mp4'), (0, 0))
+
+    run = asyncio.run(blobgc.collectGarbage(db, grace=60, batch_size=1, quarantine=False, pause=0))
+    assert (run['removed'] == 1)
+    assert (run['reclaimed_bytes'] == len(b'orphaned bytes'))
+    assert (not old.exists())
+    assert (fresh.exists())  # Inside the grace period
+    assert (get_data_path('another uuid', 'mp4').exists())
+    assert (get_data_path('a uuid', 'png').exists())
+
+    os.utime(fresh, (0, 0))
+    run = asyncio.run(blobgc.collectGarbage(db, grace=60, quarantine=True, pause=0))
+    assert (run['quarantined'] == 1 and run['reclaimed_bytes'] == 0)
+    assert (extractor.blob_store.quarantine_dir.joinpath(fresh.name).exists())
+
+    os.utime(extractor.blob_store.quarantine_dir.joinpath(fresh.name), (0, 0))  # Quarantined past the grace period
+    run = asyncio.run(blobgc.collectGarbage(db, grace=60, quarantine=True, pause=0))
+    assert (run['reclaimed_bytes'] == len(b'not committed yet'))
+    assert (not extractor.blob_store.quarantine_dir.joinpath(fresh.name).exists())
+    db.close()
+
+    response = client.get('/stats')
+    assert (response.json()['blob_gc']['runs'] >= 3)
+
+
+def test_sharded_layout(tmp_path):
+    tmp_path.joinpath('old uuid.mp4').write_bytes(b'flat bytes')
+    layout = ShardedLayout(tmp_path)
+    assert (layout.migrating)
+    assert (layout.path('old uuid', 'mp4') == tmp_path.joinpath('old uuid.mp4'))  # Still found before migrating
+
+    layout.path('new uuid', 'mp4', create=True).write_bytes(b'sharded bytes')
+    assert (layout.path('new uuid', 'mp4').parent.parent == tmp_path)
+
+    assert (asyncio.run(migrate_online(layout, batch_size=1, pause=0)) == 1)
+    assert (not layout.migrating)
+    assert (layout.path('old uuid', 'mp4').read_bytes() == b'flat bytes')
+    assert (layout.path('old uuid', 'mp4') != tmp_path.joinpath('old uuid.mp4'))
+    assert (sorted(entry.name for entry in layout.scan()) == ['new uuid.mp4', 'old uuid.mp4'])
+
+
+def test_src_while_migrating(monkeypatch, tmp_path):
+    make_test_db()
+    tmp_path.joinpath('another uuid.mp4').write_bytes(b'some 2 sound bytes')  # Not moved into its shard yet
+    layout = ShardedLayout(tmp_path)
+    monkeypatch.setattr(extractor, 'blob_store', layout)
+    monkeypatch.setattr(main, 'blob_store', layout)
+    extractor.audio_cache.discard('another uuid.mp4')
+    lookups = []
+
+    def local_path(key, local_path=layout.local_path):
+        try:
+            asyncio.get_running_loop()
+            lookups.append('event loop')
+        except RuntimeError:
+            lookups.append('blob io')
+        return local_path(key)
+
+    monkeypatch.setattr(layout, 'local_path', local_path)
+    response = client.get('/song/3/src')
+    assert (response.content == b'some 2 sound bytes')
+    assert (lookups == ['blob io'])
+    extractor.audio_cache.discard('another uuid.mp4')
+
+
+def test_s3_store():
+    client = FakeS3Client(page_size=2)
+    store = S3Store(client, 'bucket', 'btecify/')
+    assert (store.local_path('a.mp4') is None)
+    assert (store.stat('a.mp4') is None)
+
+    for key in ['a.mp4', 'b.mp4', 'c.png']:
+        store.put(key, b'0123456789')
+    assert (store.get('a.mp4') == b'0123456789')
+    assert (b''.join(store.get_range('a.mp4', 2, 8, chunk_size=3)) == b'2345678')
+    assert (client.ranges[-1] == 'bytes=2-8')
+    assert (store.stat('a.mp4').size == 10)
+    assert ([blob.key for blob in store.list()] == ['a.mp4', 'b.mp4', 'c.png'])  # Across two pages
+
+    store.quarantine('b.mp4')
+    assert ([blob.key for blob in store.list()] == ['a.mp4', 'c.png'])
+    assert ([blob.key for blob in store.quarantined()] == ['b.mp4'])
+    store.purge('b.mp4')
+    store.delete('c.png')
+    assert (list(store.quarantined()) == [] and [blob.key for blob in store.list()] == ['a.mp4'])
+
+
+def test_src_from_s3(monkeypatch):
+    make_test_db()
+    s3 = FakeS3Client()
+    store = S3Store(s3, 'bucket')
+    store.put('another uuid.mp4', b'some 2 sound bytes')
+    monkeypatch.setattr(extractor, 'blob_store', store)
+    monkeypatch.setattr(main, 'blob_store', store)
+    monkeypatch.setattr(extractor.audio_cache, 'max_item', 0)  # So it's streamed rather than cached
+    extractor.audio_cache.discard('another uuid.mp4')
+
+    response = client.get('/song/3/src', headers={'Range': 'bytes=5-'})
+    assert (response.status_code == 206)
+    assert (response.content == b'2 sound bytes')
+    assert (s3.ranges == ['bytes=5-17'])
+
+    response = client.head('/song/3/src')
+    assert (response.headers['content-length'] == '18')
+
+
+def test_blob_io():
+    io = BlobIO(2)
+
+    async def run():
+        return await asyncio.gather(*[io.run('read', lambda i: i * 2, i) for i in range(5)])
+
+    assert (asyncio.run(run()) == [0, 2, 4, 6, 8])
+    stats = io.stats()
+    assert (stats['workers'] == 2)
+    assert (stats['operations']['read']['count'] == 5)
+
+    make_test_db()
+    extractor.audio_cache.discard('another uuid.mp4')
+    reads = blob_io.timings['read'].count if 'read' in blob_io.timings else 0
+    client.get('/song/3/src', headers={'Range': 'bytes=0-3'})
+    response = client.get('/stats')
+    assert (response.json()['blob_io']['operations']['read']['count'] == reads + 1)
+
+
+def test_sqlite_profile(tmp_path):
+    url = f"sqlite:///{tmp_path.joinpath('profile.db')}"
+    writer = make_engine(url)
+    reader = make_engine(url, readonly=True)
+    with writer.begin() as connection:
+        assert (connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal')
+        assert (connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000)
+        connection.exec_driver_sql('CREATE TABLE t (x INTEGER)')
+        connection.exec_driver_sql('INSERT INTO t VALUES (1)')
+
+    with reader.connect() as connection:
+        assert (connection.exec_driver_sql('SELECT x FROM t').scalar() == 1)
+        try:
+            connection.exec_driver_sql('INSERT INTO t VALUES (2)')
+            assert False
+        except OperationalError:
+            pass
+
+    # Reads carry on while a write is in progress
+    with writer.begin() as writing:
+        writing.exec_driver_sql('INSERT INTO t VALUES (3)')
+        with reader.connect() as connection:
+            assert (connection.exec_driver_sql('SELECT count(*) FROM t').scalar() == 1)
+
+
+# Under both json modes, so the eager loads of the schema path are checked as well as the rows
+def test_constant_query_count(monkeypatch):
+    paths = ['/playlist', '/playlist?shallow=false', '/playlist/1', '/song', '/song/1']
+
+    def countQueries():
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            counts = {}
+            for path in paths:
+                statements.clear()
+                assert (client.get(path).status_code == 200)
+                counts[path] = len(statements)
+            return counts
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+    for mode in ['pydantic', 'rows']:
+        monkeypatch.setattr(main, 'json_mode', mode)
+        make_test_db()
+        small = countQueries()
+
+        db = TestingSessionLocal()
+        playlists = db.query(Playlist).all()
+        for i in range(100):
+            song = Song(title=f"more song {i}", weburl=f"https://example.com/{i}",
+                        album=Album(title=f"more album {i}"), artist=Artist(title=f"more artist {i}"))
+            for playlist in playlists:
+                db.add(PlaylistSong(song=song, playlist=playlist, dateadded=datetime(2022, 5, 1)))
+        db.commit()
+        db.close()
+
+        assert (countQueries() == small)
+        assert (len(client.get('/song').json()) == 104)
+
+
+def test_response_cache():
+    cache = ResponseCache(1024)
+    cache.put('a', 1, b'one')
+    assert (cache.get('a', 1) == b'one')
+    assert (cache.get('a', 2) is None)
+    cache.put('a', 0, b'stale')  # Built before the last commit
+    assert (cache.get('a', 1) == b'one')
+    cache.put('b', 2, b'two')
+    assert (cache.get('a', 1) is None)
+    assert (cache.get('b', 2) == b'two')
+
+    make_test_db()
+    statements = []
+
+    def record(*args):
+        statements.append(args[2])
+
+    first = client.get('/playlist', params={'shallow': 'false'})
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        second = client.get('/playlist', params={'shallow': 'false'})
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert (len(statements) == 1)  # Only the library version
+    assert (second.content == first.content)
+    assert (second.headers['etag'] == first.headers['etag'])
+    assert (second.headers['content-type'] == 'application/json')
+
+    # The version comes from the db, so commits from other workers, with their own engines, invalidate it too
+    other = make_engine(str(engine.url), pragmas={})
+    db = Session(bind=other)
+    db.query(Playlist).get(1).title = 'renamed elsewhere'
+    db.commit()
+    db.close()
+    other.dispose()
+    third = client.get('/playlist', params={'shallow': 'false'})
+    assert (third.json()[0]['title'] == 'renamed elsewhere')
+    assert (third.headers['etag'] != first.headers['etag'])
+
+    response = client.put('/playlist/1', json={'title': 'renamed'})
+    assert (response.status_code == 200)
+    assert (client.get('/playlist', params={'shallow': 'false'}).json()[0]['title'] == 'renamed')
+    assert (client.get('/playlist/1').json()['title'] == 'renamed')
+
+
+# The rows built for the json responses must encode exactly like the schemas would
+def test_json_rows_match_schemas(monkeypatch):
+    make_test_db()
+    db = TestingSessionLocal()
+    playlist = db.query(Playlist).first()
+    db.add(PlaylistSong(song=Song(title="sóng \"quoted\" ☃", weburl="https://example.com/a", duration=1e-7),
+                        playlist=playlist, dateadded=datetime(2022, 5, 1, 12, 30, 5, 123456)))
+    db.add(Song(title="in no playlist", weburl="https://example.com/b", artist=Artist(title="only artist")))
+    db.add(Playlist(title="empty"))
+    db.commit()
+    db.close()
+
+    paths = ['/playlist', '/playlist?shallow=false', '/playlist/1', '/playlist/3', '/song']
+    bodies = {}
+    for encoder in [fastjson.orjson, None]:
+        monkeypatch.setattr(fastjson, 'orjson', encoder)
+        for mode in ['pydantic', 'rows']:
+            monkeypatch.setattr(main, 'json_mode', mode)
+            main.response_cache.clear()
+            for path in paths:
+                response = client.get(path)
+                assert (response.status_code == 200)
+                assert (bodies.setdefault((encoder, path), response.text) == response.text)
+
+    for path in paths:  # orjson writes some floats differently (1e-7 rather than 1e-07), but they're the same json
+        assert (json.loads(bodies[(fastjson.orjson, path)]) == json.loads(bodies[(None, path)]))
+    assert ('"dateadded":"2022-05-01T12:30:05.123456"' in bodies[(None, '/song')])
+    assert ('sóng \\"quoted\\" ☃' in bodies[(None, '/song')])
+    assert (client.get('/playlist/10000').status_code == 404)
+
+
+def test_changes():
+    make_test_db()
+    version = client.get('/changes').json()['version']
+    assert (client.get('/changes', params={'since': version}).json()['playlists'] == [])
+
+    response = client.put('/playlist/1', json={'title': 'renamed', 'songs': [1, 4]})
+    assert (response.status_code == 200)
+    changes = client.get('/changes', params={'since': version}).json()
+    assert (changes['version'] > version)
+    assert (changes['playlists'] == [{'id': 1, 'title': 'renamed'}])
+    assert ([(m['playlist_id'], m['song_id']) for m in changes['memberships']] == [(1, 1), (1, 4)])
+    assert (changes['deleted_memberships'] == [[1, 2], [1, 3]])
+    assert (changes['songs'] == [])
+
+    version = changes['version']
+    db = TestingSessionLocal()
+    song = db.get(Song, 3)
+    song.title = "retitled"
+    song.datasize = 18  # Not part of the api, so not a change
+    db.get(Song, 2).datamime = 'audio/mp4'
+    db.commit()
+    db.close()
+    assert (client.delete('/playlist/2').status_code == 200)
+
+    changes = client.get('/changes', params={'since': version}).json()
+    assert ([song['title'] for song in changes['songs']] == ['retitled'])
+    assert (changes['albums'] == [{'id': 2, 'title': 'album1'}])
+    assert (changes['deleted_playlists'] == [2])
+    assert (changes['deleted_memberships'] == [[2, 3], [2, 4]])
+
+    # Superseded entries go without losing anything, old ones take the versions before them with them
+    db = TestingSessionLocal()
+    assert (changelog.compactChanges(db)['superseded'] > 0)
+    assert (client.get('/changes', params={'since': version}).json()['deleted_playlists'] == [2])
+    assert (client.get('/changes', params={'since': 0}).status_code == 200)
+
+    latest = client.get('/changes').json()['version']
+    changelog.compactChanges(db, retention=-1)
+    db.close()
+    assert (client.get('/changes', params={'since': version}).status_code == 410)
+    assert (client.get('/changes', params={'since': latest + 1}).status_code == 410)
+    assert (client.get('/changes').json()['version'] == latest)
+    assert (client.put('/playlist/1', json={'title': 'again'}).status_code == 200)
+    assert (client.get('/changes', params={'since': latest}).json()['playlists'] == [{'id': 1, 'title': 'again'}])
+
+
+def test_full_sync():
+    make_test_db()
+    urls = {song.id: song.weburl for song in TestingSessionLocal().query(Song)}
+
+    def song(id: int, title: str, artist: str = None, album: str = None) -> dict:
+        return {"title": title, "weburl": urls.get(id, f"https://example.com/{id}"), "artist": artist, "album": album}
+
+    library = {"playlists": [
+        {"title": "playlist1", "songs": [song(1, "song1", "artist2", "album2"), song(3, "song2", "artist1", "album1"),
+                                         song(2, "song4", "artist2", "album2")]},
+        {"title": "playlist2", "songs": [song(4, "song3", "artist1", "album1"), song(3, "song2", "artist1", "album1")]},
+    ]}
+    before = client.get('/playlist', params={'shallow': 'false'}).text
+    version = client.get('/changes').json()['version']
+
+    # Syncing the library it already has changes nothing
+    response = client.post('/fullsync', json=library)
+    assert (response.status_code == 200)
+    assert (set(response.json().values()) == {0})
+    assert (client.get('/changes').json()['version'] == version)
+    assert (client.get('/playlist', params={'shallow': 'false'}).text == before)
+
+    library = {"playlists": [
+        {"title": "playlist1", "songs": [song(1, "song1", "artist2", "album2"), song(3, "renamed", "artist1", "album1"),
+                                         song(5, "song5", "artist3")]},
+        {"title": "playlist2", "songs": [song(3, "renamed", "artist1", "album1"), song(4, "song3", "artist1", "album1")]},
+        {"title": "playlist3", "songs": [song(4, "song3", "artist1", "album1")]},
+    ]}
+    response = client.post('/fullsync', json=library)
+    assert (response.json() == {
+        'songs_added': 1, 'songs_updated': 1, 'songs_removed': 1,
+        'playlists_added': 1, 'playlists_removed': 0, 'playlists_reordered': 1,
+        'memberships_added': 2, 'memberships_removed': 1,
+        'artists_added': 1, 'artists_removed': 0, 'albums_added': 0, 'albums_removed': 0,
+    })
+    assert (client.get('/playlist').json() == [{'id': 1, 'title': 'playlist1', 'songs': [1, 3, 5]},
+                                               {'id': 2, 'title': 'playlist2', 'songs': [3, 4]},
+                                               {'id': 3, 'title': 'playlist3', 'songs': [4]}])
+    playlist = client.get('/playlist/2').json()
+    assert ([song['dateadded'] for song in playlist['songs']] == ['2022-04-25T02:40:00', '2022-04-26T02:40:00'])
+    assert (playlist['songs'][0]['title'] == 'renamed')
+    assert (client.get('/song/5').json()['artist']['title'] == 'artist3')
+
+    changes = client.get('/changes', params={'since': version}).json()
+    assert (sorted(song['id'] for song in changes['songs']) == [3, 5])
+    assert (changes['deleted_songs'] == [2])
+    assert (changes['deleted_memberships'] == [[1, 2]])
+
+    # Songs in no playlist are deleted, along with their artists and albums
+    response = client.post('/fullsync', json={"playlists": [{"title": "playlist3", "songs": [song(5, "song5")]}]})
+    assert ({k: v for k, v in response.json().items() if v} == {
+        'songs_updated': 1, 'songs_removed': 3, 'playlists_removed': 2, 'memberships_added': 1,
+        'memberships_removed': 6, 'artists_removed': 3, 'albums_removed': 2})
+    assert (client.get('/playlist').json() == [{'id': 3, 'title': 'playlist3', 'songs': [5]}])
+
 # todo: fix me with the new way thumbnails are done
 def test_get_song_thumb():
     # todo: fix this test with data in files instead of db
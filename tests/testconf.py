@@ -1,11 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
 
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 
-from app.main import app, getdb
+from app.extractor import get_data_path
+from app.main import app, getdb, getreaddb, response_cache
 from app.models import Base, Song, Album, Artist, Playlist, PlaylistSong, Thumbnail
 
 DBNAME = "../db/test.db"
@@ -22,6 +25,7 @@ def make_test_db():
     db: Session = TestingSessionLocal()
     with open(DBNAME, "w") as f:
         pass  # Overwrite db with no data to fully reset it
+    response_cache.clear()  # The versions start over with the db
 
     # Make all tables
     Base.metadata.create_all(bind=engine)
@@ -126,6 +130,74 @@ def make_test_db():
 
     db.close()
 
+    with get_data_path("another uuid", "mp4", create=True).open("wb") as f:
+        f.write(b'some 2 sound bytes')
+    with get_data_path("a uuid", "png", create=True).open("wb") as f:
+        f.write(b'some image bytes')
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code: str):
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Body(BytesIO):
+    def iter_chunks(self, chunk_size: int):
+        while chunk := self.read(chunk_size):
+            yield chunk
+
+
+# Stands in for a boto3 s3 client talking to minio, keeping objects in memory
+class FakeS3Client:
+    def __init__(self, page_size: int = 1000):
+        self.objects: dict[tuple[str, str], tuple[bytes, datetime]] = {}
+        self.page_size = page_size
+        self.ranges = []  # Range headers of every get_object, to check streaming only fetches what's needed
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        self.objects[(Bucket, Key)] = (Body, datetime.now(timezone.utc))
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str):
+        self.put_object(Bucket, Key, Path(Filename).read_bytes())
+
+    def get(self, Bucket: str, Key: str) -> tuple[bytes, datetime]:
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("NoSuchKey")
+        return self.objects[(Bucket, Key)]
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        data, _ = self.get(Bucket, Key)
+        self.ranges.append(Range)
+        if Range is not None:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": FakeS3Body(data)}
+
+    def head_object(self, Bucket: str, Key: str):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("404")
+        data, modified = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(data), "LastModified": modified}
+
+    def delete_object(self, Bucket: str, Key: str):
+        self.objects.pop((Bucket, Key), None)
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: dict, MetadataDirective: str = "COPY"):
+        data, _ = self.get(CopySource["Bucket"], CopySource["Key"])
+        self.put_object(Bucket, Key, data)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str, ContinuationToken: str = None):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + self.page_size]
+        truncated = start + self.page_size < len(keys)
+        return {
+            "Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)][0]),
+                          "LastModified": self.objects[(Bucket, key)][1]} for key in page],
+            "IsTruncated": truncated,
+            **({"NextContinuationToken": str(start + self.page_size)} if truncated else {}),
+        }
+
 
 def get_test_db():
     db = TestingSessionLocal()
@@ -144,5 +216,6 @@ def tc():
 
 
 app.dependency_overrides[getdb] = get_test_db
+app.dependency_overrides[getreaddb] = get_test_db
 
 client = TestClient(app)